@@ -1,29 +1,20 @@
-import datetime as dt
-from typing import Optional
-import nbformat
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 import typer
-import re
 from pathlib import Path
 from typing_extensions import Annotated
-from enum import Enum
-from .preprocessor import (
-    SQLExecuteProcessor,
-    CleanupProcessor,
-    StudentPreprocessor,
-    TranscludePreprocessor,
-)
-from jinja2 import (
-    Environment,
-    PackageLoader,
-    FileSystemLoader,
-    select_autoescape,
-    Undefined,
-)
-from .utils import (
-    preprocess_cells_latex,
-    preprocess_cells_markdown,
-    preprocess_cells_markdown_html,
-    sql_result_to_png,
+from .nbio import read_notebook, write_notebook
+from .preprocessor import TranscludePreprocessor
+from .server import ConversionService, make_server
+from .pipeline import (
+    ConvertMode,
+    convert_notebook,
+    evaluate_notebook,
+    evaluation_pool,
+    extract_notebook_images,
+    sheet_notebook,
+    slow_queries,
+    student_notebook,
 )
 
 app = typer.Typer(
@@ -35,14 +26,13 @@ app = typer.Typer(
 
 NB_EXT = ".ipynb"
 
-
-class ConvertMode(str, Enum):
-    latex = "latex"
-    markdown = "markdown"
-    mdhtml = "md+html"
-
-    def __str__(self):
-        return self.value
+NoValidate = Annotated[
+    bool,
+    typer.Option(
+        "--no-validate",
+        help="Skip the json schema validation of the notebooks read and written, for trusted intermediate files.",
+    ),
+]
 
 
 @app.command("eval-sql")
@@ -81,14 +71,75 @@ def evaluate_sql(
             help="File name for the evaluated notebook. If not specified, will suffix the filename with _evaluated.",
         ),
     ] = None,
+    stream: Annotated[
+        bool,
+        typer.Option(
+            "--stream",
+            help="Read query results in chunks over a server-side cursor and render them incrementally.",
+        ),
+    ] = False,
+    chunk_size: Annotated[
+        int,
+        typer.Option(
+            "--chunk-size",
+            min=1,
+            help="Number of rows fetched at once in streaming mode.",
+        ),
+    ] = 1000,
+    max_rows: Annotated[
+        Optional[int],
+        typer.Option(
+            "--max-rows",
+            min=0,
+            help="Maximum number of rows rendered per cell, the remaining rows are replaced by a truncation marker. Implies --stream.",
+        ),
+    ] = None,
+    max_bytes: Annotated[
+        Optional[int],
+        typer.Option(
+            "--max-bytes",
+            min=0,
+            help="Approximate maximum size in bytes of the rendered table per cell. Implies --stream.",
+        ),
+    ] = None,
+    jobs: Annotated[
+        int,
+        typer.Option(
+            "--jobs",
+            "-j",
+            min=1,
+            help="Number of read-only SELECT cells executed concurrently between state-changing cells.",
+        ),
+    ] = 1,
+    profile: Annotated[
+        bool,
+        typer.Option(
+            "--profile",
+            help="Record the time spent running and fetching, the row count and plan of each query in the metadata of its result cell.",
+        ),
+    ] = False,
+    slow_threshold: Annotated[
+        Optional[float],
+        typer.Option(
+            "--slow-threshold",
+            min=0,
+            help="Report the queries running for more than this number of seconds. Implies --profile.",
+        ),
+    ] = None,
+    no_validate: NoValidate = False,
 ):
-    nb = nbformat.read(notebook, as_version=4)
-    ep = SQLExecuteProcessor(timeout=600, cnx_uri=db)
-    ep.preprocess(nb, {"metadata": {"path": output_path}})
-
-    cp = CleanupProcessor()
-
-    cp.preprocess(nb)
+    nb = read_notebook(notebook, not no_validate)
+    evaluate_notebook(
+        nb,
+        db,
+        output_path,
+        stream=stream,
+        chunksize=chunk_size,
+        max_rows=max_rows,
+        max_bytes=max_bytes,
+        jobs=jobs,
+        profile=profile or slow_threshold is not None,
+    )
 
     if output_file is None:
         fname = notebook.name
@@ -98,10 +149,93 @@ def evaluate_sql(
         if not fname.endswith(NB_EXT):
             fname += NB_EXT
 
-    with open(output_path.joinpath(fname), "w", encoding="utf-8") as f:
-        nbformat.write(nb, f)
+    write_notebook(nb, output_path.joinpath(fname), not no_validate)
+    print(f"Successfully evaluated {notebook.name} and saved it into {fname}.")
+
+    if slow_threshold is not None:
+        for stats in slow_queries(nb, slow_threshold):
+            query = " ".join(stats["query"].split())
+            if len(query) > 60:
+                query = query[:57] + "..."
+            print(f"Slow query ({stats['seconds']:.3f} s, {stats['rows']} rows): {query}")
+
+
+@app.command(
+    "eval-batch",
+    help="Evaluate many notebooks with a pool of pre-warmed kernels that are reused between notebooks.",
+)
+def evaluate_sql_batch(
+    db: Annotated[
+        str,
+        typer.Argument(
+            help="Connection string used by SQLAlchemy to connect to the database."
+        ),
+    ],
+    notebooks: Annotated[
+        List[Path],
+        typer.Argument(
+            exists=True,
+            file_okay=True,
+            dir_okay=False,
+            resolve_path=True,
+            help="Paths to the notebooks to evaluate.",
+        ),
+    ],
+    output_path: Annotated[
+        Path,
+        typer.Option(
+            "--output-path",
+            exists=True,
+            file_okay=False,
+            dir_okay=True,
+            resolve_path=True,
+            help="Output path where the evaluated notebooks will be saved, suffixed with _evaluated.",
+        ),
+    ] = "./",
+    kernels: Annotated[
+        int,
+        typer.Option(
+            "--kernels",
+            "-k",
+            min=1,
+            help="Number of kernels kept started, and of notebooks evaluated at once.",
+        ),
+    ] = 2,
+    max_reuse: Annotated[
+        int,
+        typer.Option(
+            "--max-reuse",
+            min=1,
+            help="Number of times a kernel is handed out before being restarted.",
+        ),
+    ] = 20,
+    jobs: Annotated[
+        int,
+        typer.Option(
+            "--jobs",
+            "-j",
+            min=1,
+            help="Number of read-only SELECT cells executed concurrently between state-changing cells.",
+        ),
+    ] = 1,
+    no_validate: NoValidate = False,
+):
+    pool = evaluation_pool(db, kernels, max_reuse, output_path)
+
+    def evaluate(notebook: Path):
+        nb = read_notebook(notebook, not no_validate)
+        evaluate_notebook(nb, db, output_path, pool, jobs=jobs)
+        fname = notebook.name.replace(NB_EXT, "_evaluated.ipynb")
+        write_notebook(nb, output_path.joinpath(fname), not no_validate)
         print(f"Successfully evaluated {notebook.name} and saved it into {fname}.")
 
+    try:
+        with ThreadPoolExecutor(max_workers=kernels) as executor:
+            for future in [executor.submit(evaluate, n) for n in notebooks]:
+                future.result()
+    finally:
+        pool.shutdown()
+
 
 @app.command("convert")
 def convert_exercise(
@@ -148,59 +282,19 @@ def convert_exercise(
 """,
         ),
     ] = ConvertMode.markdown,
+    native_tables: Annotated[
+        bool,
+        typer.Option(
+            "--native-tables",
+            help="In latex mode, insert the results of sql queries as LaTeX tables instead of image paths, so no prior extraction is needed. Cells tagged *fitwidth* are scaled down to the line width. Needs the xcolor (with the table option) and longtable packages.",
+        ),
+    ] = False,
+    no_validate: NoValidate = False,
 ):
-    nb = nbformat.read(notebook, as_version=4)
-    image_name = notebook.name
-    image_name = image_name.replace(NB_EXT, "")
-
-    if conversion_target == ConvertMode.latex:
-        output_path = output_path.resolve()
-        cells = preprocess_cells_latex(nb, output_path, image_name)
-    elif conversion_target == ConvertMode.markdown:
-        cells = preprocess_cells_markdown(nb, output_path, image_name)
-    else:
-        cells = preprocess_cells_markdown_html(nb)
-
-    title = Undefined()
-    name = notebook.stem
-    date = dt.datetime.now()
-    author = Undefined()
-    categories = []
-    exercise_type = Undefined()
-    status = Undefined()
-    tags = []
-    description = Undefined()
-
-    if template is None:
-        env = Environment(
-            loader=PackageLoader("jupytersqlconverter"), autoescape=select_autoescape()
-        )
-        if conversion_target in [ConvertMode.markdown, ConvertMode.mdhtml]:
-            template = env.get_template("markdown.jinja")
-
-        elif conversion_target == ConvertMode.latex:
-            template = env.get_template("latex.jinja")
-    else:
-        t = template.name
-        env = Environment(loader=FileSystemLoader(template.parents[0]))
-        template = env.get_template(t)
-
-    output = template.render(
-            {
-                "title": title,
-                "name": name,
-                "author": author,
-                "date": date,
-                "categories": categories,
-                "exercise_type": exercise_type,
-                "status": status,
-                "tags": tags,
-                "description": description,
-                "cells": cells,
-            }
-        )
-    output = output.replace('    \n', '\n')
-    output = re.sub('\n\n+', '\n\n', output).rstrip()
+    nb = read_notebook(notebook, not no_validate)
+    output = convert_notebook(
+        nb, notebook.stem, output_path, conversion_target, template, native_tables
+    )
     if conversion_target == ConvertMode.latex:
         out_file = output_path.joinpath(notebook.stem + '.tex')
     if conversion_target in [ConvertMode.markdown, ConvertMode.mdhtml]:
@@ -245,15 +339,12 @@ def extract_images(
             resolve_path=True,
         ),
     ] = None,
+    no_validate: NoValidate = False,
 ):
-    nb = nbformat.read(notebook, as_version=4)
+    nb = read_notebook(notebook, not no_validate)
     image_name = notebook.name
     image_name = image_name.replace(NB_EXT, "")
-    i = 0
-    for cell in nb["cells"]:
-        i += 1
-        if not sql_result_to_png(cell, image_name + "_" + str(i), output_path):
-            i -= 1
+    extract_notebook_images(nb, image_name, output_path)
 
 
 @app.command("student")
@@ -286,10 +377,10 @@ def extract_student_version(
             help="File name for the student notebook. If not specified, will suffix the filename with _student.",
         ),
     ] = None,
+    no_validate: NoValidate = False,
 ):
-    nb = nbformat.read(notebook, as_version=4)
-    ep = StudentPreprocessor(timeout=600)
-    ep.preprocess(nb, {"metadata": {"path": output_path}})
+    nb = read_notebook(notebook, not no_validate)
+    student_notebook(nb, output_path)
 
     if output_file is None:
         fname = notebook.name
@@ -299,11 +390,10 @@ def extract_student_version(
         if not fname.endswith(NB_EXT):
             fname += NB_EXT
 
-    with open(output_path.joinpath(fname), "w", encoding="utf-8") as f:
-        nbformat.write(nb, f)
-        print(
-            f"Successfully extracted the student version from {notebook.name} and saved it into {fname}."
-        )
+    write_notebook(nb, output_path.joinpath(fname), not no_validate)
+    print(
+        f"Successfully extracted the student version from {notebook.name} and saved it into {fname}."
+    )
 
 @app.command("transclude")
 def transclude(
@@ -335,8 +425,9 @@ def transclude(
             help="File name for the new notebook. If not specified, will suffix the filename with _transcluded.",
         ),
     ] = None,
+    no_validate: NoValidate = False,
 ):
-    nb = nbformat.read(notebook, as_version=4)
+    nb = read_notebook(notebook, not no_validate)
     ep = TranscludePreprocessor()
     ep.preprocess(nb, notebook.parent)
 
@@ -348,11 +439,159 @@ def transclude(
         if not fname.endswith(NB_EXT):
             fname += NB_EXT
 
-    with open(output_path.joinpath(fname), "w", encoding="utf-8") as f:
-        nbformat.write(nb, f)
-        print(
-            f"Successfully transcluded from {notebook.name} and saved it into {fname}."
-        )
+    write_notebook(nb, output_path.joinpath(fname), not no_validate)
+    print(
+        f"Successfully transcluded from {notebook.name} and saved it into {fname}."
+    )
+
+
+@app.command(
+    "sheet",
+    help="Build an exercise sheet: transclude the included notebooks and evaluate the result, running identical queries and rendering identical tables only once.",
+)
+def build_sheet(
+    db: Annotated[
+        str,
+        typer.Argument(
+            help="Connection string used by SQLAlchemy to connect to the database."
+        ),
+    ],
+    notebook: Annotated[
+        Path,
+        typer.Argument(
+            exists=True,
+            file_okay=True,
+            dir_okay=False,
+            resolve_path=True,
+            help="Path to the sheet notebook including the exercises.",
+        ),
+    ],
+    output_path: Annotated[
+        Path,
+        typer.Argument(
+            exists=True,
+            file_okay=False,
+            dir_okay=True,
+            resolve_path=True,
+            help="Output path where the evaluated sheet will be saved",
+        ),
+    ] = "./",
+    output_file: Annotated[
+        Optional[str],
+        typer.Option(
+            "--out",
+            "-o",
+            help="File name for the evaluated sheet. If not specified, will suffix the filename with _evaluated.",
+        ),
+    ] = None,
+    extract: Annotated[
+        bool,
+        typer.Option(
+            "--extract",
+            help="Also save the results of the queries as png images in the output path.",
+        ),
+    ] = False,
+    jobs: Annotated[
+        int,
+        typer.Option(
+            "--jobs",
+            "-j",
+            min=1,
+            help="Number of read-only SELECT cells executed concurrently between state-changing cells.",
+        ),
+    ] = 1,
+    no_validate: NoValidate = False,
+):
+    nb = read_notebook(notebook, not no_validate)
+    sheet_notebook(nb, db, notebook.parent, output_path, jobs=jobs)
+
+    if output_file is None:
+        fname = notebook.name
+        fname = fname.replace(NB_EXT, "_evaluated.ipynb")
+    else:
+        fname = output_file
+        if not fname.endswith(NB_EXT):
+            fname += NB_EXT
+
+    write_notebook(nb, output_path.joinpath(fname), not no_validate)
+    keys = [c["metadata"]["sql_result_key"] for c in nb["cells"] if "sql_result_key" in c["metadata"]]
+    print(
+        f"Successfully evaluated {notebook.name} and saved it into {fname}, "
+        f"{len(keys) - len(set(keys))} of {len(keys)} query results were reused."
+    )
+    if extract:
+        extract_notebook_images(nb, notebook.stem, output_path)
+
+@app.command(
+    "serve",
+    help="Run a local conversion service exposing eval/student/convert/extract jobs over a Unix socket, or HTTP on a loopback address. There is no authentication, the Unix socket is the intended transport.",
+)
+def serve(
+    host: Annotated[
+        str,
+        typer.Option("--host", help="Loopback address to listen on, other addresses are refused."),
+    ] = "127.0.0.1",
+    port: Annotated[
+        int,
+        typer.Option("--port", "-p", help="Port to listen on."),
+    ] = 8765,
+    unix_socket: Annotated[
+        Optional[Path],
+        typer.Option(
+            "--socket",
+            dir_okay=False,
+            resolve_path=True,
+            help="Listen on this Unix socket instead of a TCP port.",
+        ),
+    ] = None,
+    workers: Annotated[
+        int,
+        typer.Option("--workers", "-w", min=1, help="Number of worker threads."),
+    ] = 2,
+    queue_size: Annotated[
+        int,
+        typer.Option(
+            "--queue-size",
+            min=1,
+            help="Maximum number of queued jobs, further jobs are rejected until the queue drains.",
+        ),
+    ] = 16,
+    kernels: Annotated[
+        int,
+        typer.Option(
+            "--kernels",
+            "-k",
+            min=0,
+            help="Number of pre-warmed kernels kept per database for eval jobs, 0 to start a fresh kernel per job.",
+        ),
+    ] = 0,
+    max_reuse: Annotated[
+        int,
+        typer.Option(
+            "--max-reuse",
+            min=1,
+            help="Number of times a pooled kernel is handed out before being restarted.",
+        ),
+    ] = 20,
+):
+    service = ConversionService(
+        workers=workers, queue_size=queue_size, kernels=kernels, max_reuse=max_reuse
+    )
+    try:
+        server = make_server(service, host, port, unix_socket)
+    except ValueError as e:
+        service.shutdown()
+        raise typer.BadParameter(str(e), param_hint="--host")
+    where = unix_socket if unix_socket is not None else f"http://{host}:{port}"
+    print(f"Serving on {where} with {workers} workers.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
 
 if __name__ == "__main__":
     # calling the main function
@@ -0,0 +1,111 @@
+from typing import FrozenSet, Iterable, Iterator, List, Optional
+from nbformat import NotebookNode
+
+
+DEFAULT_DATEFORMAT = "YYYY-MM-DD"
+LIST_MARKERS = frozenset(["enum:start", "enum:cont", "enum:end", "item:start", "item:end"])
+
+
+class CellRecord:
+    """Classification of a notebook cell, computed once from its tags."""
+
+    __slots__ = (
+        "index",
+        "cell",
+        "cell_type",
+        "tagged",
+        "tags",
+        "limit",
+        "dateformat",
+        "markers",
+        "solution",
+    )
+
+    def __init__(self, index: int, cell: NotebookNode):
+        self.index = index
+        self.cell = cell
+        self.cell_type = cell["cell_type"]
+        self.tagged = "tags" in cell["metadata"]
+        tags = cell["metadata"]["tags"] if self.tagged else []
+        self.tags: FrozenSet[str] = frozenset(tags)
+        self.limit: Optional[int] = None
+        self.dateformat = DEFAULT_DATEFORMAT
+        limit = next((t for t in tags if t.startswith("limit:")), None)
+        if limit is not None:
+            self.limit = int(limit.split(":")[1])
+        dateformat = next((t for t in tags if t.startswith("dateformat:")), None)
+        if dateformat is not None:
+            self.dateformat = dateformat.split(":", 1)[1]
+        self.markers = self.tags & LIST_MARKERS
+        self.solution: Optional[str] = None
+
+    def derive(self, index: int, cell: NotebookNode, add: Iterable[str] = ()) -> "CellRecord":
+        """Record for a copy of this cell, reusing the parsed parameters."""
+        record = CellRecord.__new__(CellRecord)
+        for name in CellRecord.__slots__:
+            setattr(record, name, getattr(self, name))
+        record.index = index
+        record.cell = cell
+        record.tags = self.tags.union(add)
+        record.tagged = self.tagged or bool(record.tags)
+        return record
+
+    @property
+    def is_sql(self) -> bool:
+        return "sql" in self.tags
+
+
+class CompiledNotebook:
+    """Cell records of a notebook, with the solution blocks already indexed."""
+
+    __slots__ = ("nb", "cells")
+
+    def __init__(self, nb: NotebookNode, cells: Optional[List[CellRecord]] = None):
+        self.nb = nb
+        if cells is None:
+            cells = [CellRecord(i, c) for i, c in enumerate(nb["cells"])]
+        self.cells = cells
+        for record, solution in zip(cells, index_solution_cells(cells)):
+            record.solution = solution
+
+    def __iter__(self) -> Iterator[CellRecord]:
+        return iter(self.cells)
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    def __getitem__(self, index: int) -> CellRecord:
+        return self.cells[index]
+
+
+def compile_notebook(nb) -> CompiledNotebook:
+    if isinstance(nb, CompiledNotebook):
+        return nb
+    return CompiledNotebook(nb)
+
+
+def index_solution_cells(cells: List[CellRecord]) -> List[str]:
+    cell_index = [None]
+    for cell in cells:
+        if "correction" in cell.tags:
+            if cell_index[-1] is None:
+                cell_index.append("solution_start_end")
+            elif cell_index[-1] == "solution_start_end":
+                cell_index[-1] = "solution_start"
+                cell_index.append("solution")
+            elif cell_index[-1] == "solution":
+                cell_index.append("solution")
+            else:
+                raise Exception(f"Unexpected cell type in solution cells : {cell_index}")
+        else:
+            if cell_index[-1] is None:
+                cell_index.append(None)
+            elif cell_index[-1] in ["solution_start_end", "solution_end"]:
+                cell_index.append(None)
+            elif cell_index[-1] == "solution":
+                cell_index[-1] = "solution_end"
+                cell_index.append(None)
+            else:
+                raise Exception(f"Unexpected cell type in non-solution cells : {cell_index}")
+    cell_index.pop(0)
+    return cell_index
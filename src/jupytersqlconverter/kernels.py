@@ -0,0 +1,132 @@
+import os
+import queue
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+from jupyter_client.client import KernelClient
+from jupyter_client.manager import KernelManager
+from nbconvert.preprocessors import ExecutePreprocessor
+from nbformat import NotebookNode
+
+
+class PooledKernel:
+    __slots__ = ("km", "uses", "cwd")
+
+    def __init__(self, km: KernelManager, cwd: str):
+        self.km = km
+        self.uses = 0
+        self.cwd = cwd
+
+
+class KernelPool:
+    """Pool of started kernels, warmed up with setup code and reused across notebooks.
+
+    When a kernel is handed back, its user namespace is cleared and the setup code
+    run again, through the client the preprocessor already opened. Kernels are
+    restarted once they have been handed out max_uses times, or if they died.
+    """
+
+    def __init__(
+        self,
+        size: int = 2,
+        setup_code: str = "",
+        max_uses: int = 20,
+        cwd: Optional[Path] = None,
+        kernel_name: str = "python3",
+        timeout: int = 60,
+    ):
+        self.setup_code = setup_code
+        self.max_uses = max_uses
+        self.cwd = str(cwd) if cwd is not None else os.getcwd()
+        self.kernel_name = kernel_name
+        self.timeout = timeout
+        self.idle: "queue.Queue[PooledKernel]" = queue.Queue()
+        self.kernels: List[PooledKernel] = []
+        try:
+            for _ in range(size):
+                km = KernelManager(kernel_name=kernel_name)
+                km.start_kernel(cwd=self.cwd)
+                kernel = PooledKernel(km, self.cwd)
+                self.kernels.append(kernel)
+                self.execute(kernel, self.setup_code)
+                self.idle.put(kernel)
+        except BaseException:
+            self.shutdown()
+            raise
+
+    def execute(self, kernel: PooledKernel, code: str, kc: Optional[KernelClient] = None):
+        """Run code in a kernel, with a new client unless one is given."""
+        own_client = kc is None
+        if own_client:
+            kc = kernel.km.client()
+            kc.start_channels()
+        try:
+            if own_client:
+                kc.wait_for_ready(timeout=self.timeout)
+            reply = kc.execute_interactive(
+                code,
+                store_history=False,
+                timeout=self.timeout,
+                output_hook=lambda msg: None,
+            )
+        finally:
+            if own_client:
+                kc.stop_channels()
+        if reply["content"]["status"] != "ok":
+            raise RuntimeError(
+                f"Kernel setup failed: {reply['content'].get('evalue', reply['content']['status'])}"
+            )
+
+    def restart(self, kernel: PooledKernel):
+        kernel.km.restart_kernel(now=True)
+        kernel.uses = 0
+        kernel.cwd = self.cwd
+        self.execute(kernel, f"import os\nos.chdir({self.cwd!r})\n{self.setup_code}")
+
+    def reset(self, kernel: PooledKernel, kc: Optional[KernelClient]):
+        """Clear a kernel handed back with the client it was used with, which is stopped.
+
+        The kernel is restarted, once the client is stopped, if it reached max_uses,
+        died or could not be reset.
+        """
+        kernel.uses += 1
+        try:
+            if kernel.uses < self.max_uses and kernel.km.is_alive():
+                self.execute(
+                    kernel, f"%reset -f\nimport os\nos.chdir({self.cwd!r})\n{self.setup_code}", kc
+                )
+                kernel.cwd = self.cwd
+                return
+        except Exception:
+            pass
+        finally:
+            # nbclient only cleans up the client when it owns the kernel
+            if kc is not None:
+                kc.stop_channels()
+        self.restart(kernel)
+
+    def preprocess(
+        self,
+        processor: ExecutePreprocessor,
+        nb: NotebookNode,
+        resources: Any = None,
+        path: Optional[Path] = None,
+    ) -> Tuple[NotebookNode, dict]:
+        """Run an execute preprocessor on a borrowed kernel, running in path if given."""
+        kernel = self.idle.get()
+        try:
+            if path is not None and str(path) != kernel.cwd:
+                self.execute(kernel, f"import os\nos.chdir({str(path)!r})")
+                kernel.cwd = str(path)
+            return processor.preprocess(nb, resources, kernel.km)
+        finally:
+            kc, processor.kc = processor.kc, None
+            try:
+                self.reset(kernel, kc)
+            finally:
+                self.idle.put(kernel)
+
+    def shutdown(self):
+        for kernel in self.kernels:
+            kernel.km.shutdown_kernel(now=True)
+        self.kernels = []
@@ -0,0 +1,148 @@
+import json
+import os
+import stat
+import uuid
+from pathlib import Path
+
+import nbformat
+from nbformat import NotebookNode, ValidationError, from_dict as nb_from_dict
+from nbformat.corpus.words import generate_corpus_id
+from traitlets.log import get_logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Mimetypes other than text/* stored as lists of lines, as in nbformat.v4.rwbase
+SPLIT_MIMETYPES = frozenset(["application/javascript", "image/svg+xml"])
+
+
+def loads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> bytes:
+    """Serialize like nbformat does, with orjson if it is installed (which only indents by 2)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS) + b"\n"
+    return (json.dumps(obj, sort_keys=True, indent=1, ensure_ascii=False) + "\n").encode()
+
+
+def validate(nb: NotebookNode):
+    # Invalid notebooks are reported but still processed, as nbformat.read does
+    try:
+        nbformat.validate(nb)
+    except ValidationError as e:
+        get_logger().error("Notebook JSON is invalid: %s", e)
+
+
+def _join(text):
+    return "".join(text) if isinstance(text, list) else text
+
+
+def _join_bundle(data: dict) -> dict:
+    return {
+        k: v if k == "application/json" or k.endswith("+json") else _join(v)
+        for k, v in data.items()
+    }
+
+
+def _rejoin_lines(d: dict):
+    """Rejoin the multiline strings before building the NotebookNode, which then has
+    one string to convert instead of one per line."""
+    for cell in d["cells"]:
+        cell["source"] = _join(cell.get("source", ""))
+        if "attachments" in cell:
+            cell["attachments"] = {k: _join_bundle(v) for k, v in cell["attachments"].items()}
+        for output in cell.get("outputs", []):
+            if "data" in output:
+                output["data"] = _join_bundle(output["data"])
+            if "text" in output:
+                output["text"] = _join(output["text"])
+
+
+def notebook_from_dict(d: dict, validate_nb: bool = True) -> NotebookNode:
+    """Notebook from its json structure, converted to version 4 if needed."""
+    if d.get("nbformat") != 4:
+        return nbformat.reads(json.dumps(d), as_version=4)
+    _rejoin_lines(d)
+    nb = nb_from_dict(d)
+    if validate_nb:
+        validate(nb)
+    return nb
+
+
+def _split(text):
+    return text.splitlines(True) if isinstance(text, str) else text
+
+
+def _split_bundle(data: dict) -> dict:
+    return {
+        k: _split(v) if k.startswith("text/") or k in SPLIT_MIMETYPES else v
+        for k, v in data.items()
+    }
+
+
+def notebook_to_dict(nb: NotebookNode) -> dict:
+    """Json structure of a notebook as nbformat writes it, without copying the outputs data."""
+    cells = []
+    # Cell ids are required since 4.5, validation adds the missing ones but may be skipped
+    needs_id = nb.get("nbformat_minor", 0) >= 5
+    for cell in nb["cells"]:
+        cell = dict(cell, source=_split(cell["source"]))
+        if needs_id and "id" not in cell:
+            cell["id"] = generate_corpus_id()
+        if "trusted" in cell["metadata"]:
+            cell["metadata"] = {k: v for k, v in cell["metadata"].items() if k != "trusted"}
+        if "attachments" in cell:
+            cell["attachments"] = {k: _split_bundle(v) for k, v in cell["attachments"].items()}
+        if "outputs" in cell:
+            outputs = []
+            for output in cell["outputs"]:
+                if output["output_type"] in ("execute_result", "display_data"):
+                    output = dict(output, data=_split_bundle(output.get("data", {})))
+                elif output["output_type"] == "stream":
+                    output = dict(output, text=_split(output["text"]))
+                outputs.append(output)
+            cell["outputs"] = outputs
+        cells.append(cell)
+    metadata = {
+        k: v
+        for k, v in nb["metadata"].items()
+        if k not in ("orig_nbformat", "orig_nbformat_minor", "signature")
+    }
+    return dict(nb, cells=cells, metadata=metadata)
+
+
+def read_notebook(path: Path, validate_nb: bool = True) -> NotebookNode:
+    """Read a notebook, skipping the json schema validation if validate_nb is False."""
+    return notebook_from_dict(loads(Path(path).read_bytes()), validate_nb)
+
+
+def write_notebook(nb: NotebookNode, path: Path, validate_nb: bool = True):
+    """Write a notebook atomically, through a temporary file renamed over path.
+
+    The file keeps the permissions of the one it replaces, new files get the default
+    permissions given by the umask.
+    """
+    if validate_nb:
+        validate(nb)
+    path = Path(path)
+    data = dumps(notebook_to_dict(nb))
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        try:
+            os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
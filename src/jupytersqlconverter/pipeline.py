@@ -0,0 +1,191 @@
+import datetime as dt
+import re
+import shutil
+from enum import Enum
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional
+from jinja2 import (
+    Environment,
+    PackageLoader,
+    FileSystemLoader,
+    select_autoescape,
+    Template,
+    Undefined,
+)
+from nbformat import NotebookNode
+from .ir import compile_notebook
+from .kernels import KernelPool
+from .preprocessor import (
+    SQLExecuteProcessor,
+    CleanupProcessor,
+    StudentPreprocessor,
+    TranscludePreprocessor,
+)
+from .utils import (
+    preprocess_cells_latex,
+    preprocess_cells_markdown,
+    preprocess_cells_markdown_html,
+    sql_result_to_png,
+)
+
+
+class ConvertMode(str, Enum):
+    latex = "latex"
+    markdown = "markdown"
+    mdhtml = "md+html"
+
+    def __str__(self):
+        return self.value
+
+
+@lru_cache(maxsize=None)
+def default_template(mode: ConvertMode) -> Template:
+    """Load the packaged conversion template for a mode, once."""
+    env = Environment(
+        loader=PackageLoader("jupytersqlconverter"), autoescape=select_autoescape()
+    )
+    if mode in [ConvertMode.markdown, ConvertMode.mdhtml]:
+        return env.get_template("markdown.jinja")
+    return env.get_template("latex.jinja")
+
+
+def get_template(mode: ConvertMode, template: Optional[Path] = None) -> Template:
+    """Conversion template, the default one for the mode if none is given.
+
+    Given templates are loaded on every call so that edits to them are picked up.
+    """
+    if template is None:
+        return default_template(mode)
+    env = Environment(loader=FileSystemLoader(template.parents[0]))
+    return env.get_template(template.name)
+
+
+def evaluate_notebook(
+    nb: NotebookNode, db: str, path: Path, pool: Optional[KernelPool] = None, **options
+) -> NotebookNode:
+    """Execute the SQL cells of a notebook and turn their results into markdown cells.
+
+    Kernels are borrowed from pool when given, options are passed on to
+    SQLExecuteProcessor.
+    """
+    ep = SQLExecuteProcessor(timeout=600, cnx_uri=db, **options)
+    cp = CleanupProcessor()
+
+    if pool is None:
+        ep.preprocess(nb, {"metadata": {"path": path}})
+        cp.preprocess(nb)
+    else:
+        pool.preprocess(ep, nb, {"metadata": {"path": path}}, path)
+        pool.preprocess(cp, nb, path=path)
+    return nb
+
+
+def sheet_notebook(
+    nb: NotebookNode,
+    db: str,
+    source_path: Path,
+    path: Path,
+    pool: Optional[KernelPool] = None,
+    **options,
+) -> NotebookNode:
+    """Transclude the notebooks included in an exercise sheet and evaluate the result,
+    running the identical queries found across the included notebooks only once."""
+    TranscludePreprocessor().preprocess(nb, source_path)
+    return evaluate_notebook(nb, db, path, pool, dedup=True, **options)
+
+
+def slow_queries(nb: NotebookNode, threshold: float) -> List[dict]:
+    """Stats of the profiled queries of an evaluated notebook that ran for more than threshold seconds."""
+    return [
+        c["metadata"]["sql_stats"]
+        for c in nb["cells"]
+        if c["metadata"].get("sql_stats", {}).get("seconds", 0) > threshold
+    ]
+
+
+def evaluation_pool(
+    db: str, size: int, max_uses: int = 20, cwd: Optional[Path] = None
+) -> KernelPool:
+    """Kernel pool warmed up with the imports and engine used by the SQL cells."""
+    setup_code = SQLExecuteProcessor(cnx_uri=db).kernel_setup_code()
+    return KernelPool(size=size, setup_code=setup_code, max_uses=max_uses, cwd=cwd)
+
+
+def student_notebook(
+    nb: NotebookNode, path: Path, pool: Optional[KernelPool] = None
+) -> NotebookNode:
+    ep = StudentPreprocessor(timeout=600)
+    if pool is None:
+        ep.preprocess(nb, {"metadata": {"path": path}})
+    else:
+        pool.preprocess(ep, nb, {"metadata": {"path": path}}, path)
+    return nb
+
+
+def convert_notebook(
+    nb: NotebookNode,
+    name: str,
+    output_path: Path,
+    mode: ConvertMode = ConvertMode.markdown,
+    template: Optional[Path] = None,
+    native_tables: bool = False,
+) -> str:
+    """Render an evaluated notebook as a single latex or markdown document."""
+    compiled = compile_notebook(nb)
+    if mode == ConvertMode.latex:
+        output_path = output_path.resolve()
+        cells = preprocess_cells_latex(compiled, output_path, name, native_tables)
+    elif mode == ConvertMode.markdown:
+        cells = preprocess_cells_markdown(compiled, output_path, name)
+    else:
+        cells = preprocess_cells_markdown_html(compiled)
+
+    title = Undefined()
+    date = dt.datetime.now()
+    author = Undefined()
+    categories = []
+    exercise_type = Undefined()
+    status = Undefined()
+    tags = []
+    description = Undefined()
+
+    output = get_template(mode, template).render(
+            {
+                "title": title,
+                "name": name,
+                "author": author,
+                "date": date,
+                "categories": categories,
+                "exercise_type": exercise_type,
+                "status": status,
+                "tags": tags,
+                "description": description,
+                "cells": cells,
+            }
+        )
+    output = output.replace('    \n', '\n')
+    output = re.sub('\n\n+', '\n\n', output).rstrip()
+    return output
+
+
+def extract_notebook_images(nb: NotebookNode, image_name: str, output_path: Path) -> List[Path]:
+    """Save the results of the queries of a notebook as png images.
+
+    Identical results are rendered once, the other images are copies.
+    """
+    images = []
+    rendered = {}
+    i = 0
+    for record in compile_notebook(nb):
+        if "sql_result" in record.tags:
+            i += 1
+            image = output_path.joinpath(image_name + "_" + str(i) + ".png")
+            key = record.cell["metadata"].get("sql_result_key", record.cell["source"])
+            if key in rendered:
+                shutil.copyfile(rendered[key], image)
+            else:
+                sql_result_to_png(record.cell, image_name + "_" + str(i), output_path)
+                rendered[key] = image
+            images.append(image)
+    return images
@@ -1,12 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Tuple
 from jupyter_client.manager import KernelManager
 from nbconvert.preprocessors import ExecutePreprocessor, Preprocessor
 from nbformat import NotebookNode, from_dict as nb_from_dict
+from nbformat.v4 import new_output
+from sqlalchemy import create_engine
+from .ir import CellRecord, CompiledNotebook, compile_notebook
+from .nbio import read_notebook
+from .query import (
+    STATS_MIME,
+    FetchClock,
+    query_html,
+    query_stats,
+    set_session,
+    stream_query_html,
+)
+from .statements import normalize, split_statements
 
+import copy
+import hashlib
+import json
 import re
-import fnmatch
-import nbformat
+
+READ_ONLY_QUERY = re.compile(r"(\(\s*)*(SELECT|WITH)\b", re.I)
 
 
 class SQLExecuteProcessor(ExecutePreprocessor):
@@ -17,19 +34,51 @@ class SQLExecuteProcessor(ExecutePreprocessor):
         "DD/MM/RR": "%d/%m/%y",
     }
 
-    def __init__(self, cnx_uri, **kw):
+    def __init__(
+        self,
+        cnx_uri,
+        stream=False,
+        chunksize=1000,
+        max_rows=None,
+        max_bytes=None,
+        jobs=1,
+        engine=None,
+        profile=False,
+        dedup=False,
+        **kw,
+    ):
         super().__init__(**kw)
+        self.cnx_uri = cnx_uri
+        self.jobs = jobs
+        # An engine given by the caller is shared, only the engines created here are disposed of
+        self.engine = engine
+        self.owns_engine = engine is None
+        self.compiled = None
+        self.fetched = {}
+        self.concurrent_runs = {}
+        self.dedup = dedup
+        self.result_keys = {}
+        self.results = {}
+        self.deduplicated = 0
+        self.stream = stream or max_rows is not None or max_bytes is not None
+        self.chunksize = chunksize
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.profile = profile
         self.import_str = (
             "import pandas as pd\nfrom sqlalchemy import create_engine, text\nfrom sqlalchemy.exc import DatabaseError"
         )
+        if profile:
+            self.import_str += "\nfrom jupytersqlconverter.query import STATS_MIME, FetchClock, query_stats"
         self.db_cnx = f"""if 'engine' not in locals():
     engine = create_engine('{cnx_uri}')
 """
         self.db_query = """with engine.connect() as conn:
-    conn.execute(text(\"ALTER SESSION SET NLS_TERRITORY = FRANCE\"))
-    conn.execute(text(\"ALTER SESSION SET NLS_LANGUAGE = FRENCH\"))
-    conn.execute(text(\"ALTER SESSION SET NLS_DATE_FORMAT = '{dateformat}'\"))
-    df = pd.read_sql(sql=\"\"\"{source}\"\"\", con=conn)
+    if conn.dialect.name == "oracle":
+        conn.execute(text(\"ALTER SESSION SET NLS_TERRITORY = FRANCE\"))
+        conn.execute(text(\"ALTER SESSION SET NLS_LANGUAGE = FRENCH\"))
+        conn.execute(text(\"ALTER SESSION SET NLS_DATE_FORMAT = '{dateformat}'\"))
+{timer}    df = {read_sql}(sql=\"\"\"{source}\"\"\", con=conn)
     for x in df.select_dtypes(include=['datetime64']).columns.tolist():
         df[x] = df[x].dt.strftime('{dateformat_str}')
     for x in df.select_dtypes(include=['float64']).columns.tolist():
@@ -37,12 +86,22 @@ class SQLExecuteProcessor(ExecutePreprocessor):
     df.fillna("(null)",inplace=True)
     df = df.replace("nan", "(null)")
     df.index += 1
-{limiter}
+{profiler}{limiter}
+"""
+        self.db_query_stream = """from jupytersqlconverter.query import stream_query_html
+with engine.connect() as conn:
+    if conn.dialect.name == "oracle":
+        conn.execute(text(\"ALTER SESSION SET NLS_TERRITORY = FRANCE\"))
+        conn.execute(text(\"ALTER SESSION SET NLS_LANGUAGE = FRENCH\"))
+        conn.execute(text(\"ALTER SESSION SET NLS_DATE_FORMAT = '{dateformat}'\"))
+{timer}    html, rows = stream_query_html(conn, \"\"\"{source}\"\"\", '{dateformat_str}', chunksize={chunksize}, limit={limit}, max_rows={max_rows}, max_bytes={max_bytes}{clock})
+{profiler}html
 """
         self.db_query_except = """with engine.connect() as conn:
-    conn.execute(text(\"ALTER SESSION SET NLS_TERRITORY = FRANCE\"))
-    conn.execute(text(\"ALTER SESSION SET NLS_LANGUAGE = FRENCH\"))
-    conn.execute(text(\"ALTER SESSION SET NLS_DATE_FORMAT = '{dateformat}'\"))
+    if conn.dialect.name == "oracle":
+        conn.execute(text(\"ALTER SESSION SET NLS_TERRITORY = FRANCE\"))
+        conn.execute(text(\"ALTER SESSION SET NLS_LANGUAGE = FRENCH\"))
+        conn.execute(text(\"ALTER SESSION SET NLS_DATE_FORMAT = '{dateformat}'\"))
     try:
         df = pd.read_sql(sql=\"\"\"{source}\"\"\", con=conn)
         for x in df.select_dtypes(include=['datetime64']).columns.tolist():
@@ -53,26 +112,47 @@ class SQLExecuteProcessor(ExecutePreprocessor):
         df = df.replace("nan", "(null)")
         df.index += 1
     except Exception as e:
-        err, = e.orig.args
-        print(err.message)
+        orig = getattr(e, "orig", None) or getattr(e.__cause__, "orig", e)
+        err, = orig.args
+        print(getattr(err, "message", err))
 """
 
-        self.no_result_query = """with engine.connect() as conn:
-    conn.execute(text(\"ALTER SESSION SET NLS_TERRITORY = FRANCE\"))
-    conn.execute(text(\"ALTER SESSION SET NLS_LANGUAGE = FRENCH\"))
-    conn.execute(text(\"ALTER SESSION SET NLS_DATE_FORMAT = '{dateformat}'\"))
-    conn.execute(text(\"\"\"{source}\"\"\"))
-    conn.commit()
+        self.no_result_query = """from jupytersqlconverter.statements import execute_script
+with engine.connect() as conn:
+    if conn.dialect.name == "oracle":
+        conn.execute(text(\"ALTER SESSION SET NLS_TERRITORY = FRANCE\"))
+        conn.execute(text(\"ALTER SESSION SET NLS_LANGUAGE = FRENCH\"))
+        conn.execute(text(\"ALTER SESSION SET NLS_DATE_FORMAT = '{dateformat}'\"))
+    execute_script(conn, \"\"\"{source}\"\"\")
 """
 
+    def kernel_setup_code(self) -> str:
+        """Code run in a pooled kernel so the cells find everything already imported."""
+        return (
+            self.import_str
+            + "\nimport jupytersqlconverter.query, jupytersqlconverter.statements\n"
+            + self.db_cnx
+        )
+
     def preprocess(
         self, nb: NotebookNode, resources: Any = None, km: KernelManager | None = None
     ) -> Tuple[NotebookNode, dict]:
-        cells = nb["cells"][:]
+        compiled = compile_notebook(nb)
         nb["cells"] = []
-        for c in cells:
-            if "tags" in c["metadata"] and "sql" in c["metadata"]["tags"]:
-                if "hideinput" not in c["metadata"]["tags"]:
+        records = []
+
+        def append(cell, record=None, add=()):
+            if record is None:
+                records.append(CellRecord(len(nb["cells"]), cell))
+            else:
+                records.append(record.derive(len(nb["cells"]), cell, add))
+            nb["cells"].append(cell)
+
+        for record in compiled:
+            c = record.cell
+            added = ()
+            if record.is_sql:
+                if "hideinput" not in record.tags:
                     pre = {
                         "cell_type": "markdown",
                         "metadata": {},
@@ -82,46 +162,175 @@ class SQLExecuteProcessor(ExecutePreprocessor):
                     if "enum:end" in pre["metadata"]["tags"]:
                         pre["metadata"]["tags"].remove("enum:end")
                     pre["metadata"]["tags"].append("sql_source")
-                    nb["cells"].append(nb_from_dict(pre))
+                    append(nb_from_dict(pre))
                 c["metadata"]["tags"].append("sql_execute")
-            if "tags" in c["metadata"] and "ignore" in c["metadata"]["tags"]:
+                added = ("sql_execute",)
+            if "ignore" in record.tags:
                 continue
-            elif "tags" in c["metadata"] and "sql" in c["metadata"]["tags"] and "plsql" not in c["metadata"]["tags"]:
-                import copy
-                if ";" in c["source"].rstrip().rstrip(";"):
-                    for s in c["source"].rstrip().rstrip(";").split(";"):
-                        if s.strip() != "":
-                            c_split = copy.deepcopy(c)
-                            c_split["source"] = s
-                            nb["cells"].append(c_split)
+            elif (
+                record.is_sql
+                and "plsql" not in record.tags
+                and "noresult" not in record.tags
+            ):
+                statements = split_statements(c["source"])
+                if len(statements) > 1:
+                    for s in statements:
+                        c_split = copy.deepcopy(c)
+                        c_split["source"] = s
+                        append(c_split, record, added)
                 else:
-                    nb["cells"].append(c)
+                    append(c, record, added)
             else:
-                nb["cells"].append(c)
-        return super().preprocess(nb, resources, km)
+                append(c, record, added)
+        self.compiled = CompiledNotebook(nb, records)
+        self.fetched = {}
+        self.concurrent_runs = {}
+        if self.jobs > 1:
+            self.concurrent_runs = self.index_concurrent_runs(self.compiled)
+        self.result_keys = {}
+        self.results = {}
+        self.deduplicated = 0
+        if self.dedup:
+            self.result_keys = self.index_result_keys(self.compiled)
+        try:
+            return super().preprocess(nb, resources, km)
+        finally:
+            if self.owns_engine and self.engine is not None:
+                self.engine.dispose()
+                self.engine = None
+
+    def query_params(self, record: CellRecord) -> Tuple[str, int | None, str]:
+        query = record.cell["source"]
+        if "plsql" not in record.tags:
+            query = query.rstrip().rstrip(";")
+        else:
+            query = query.rstrip().rstrip("/").rstrip()
+        return query, record.limit, record.dateformat
+
+    def is_read_only(self, record: CellRecord) -> bool:
+        """Tell whether a cell can run outside the kernel, concurrently with its neighbours."""
+        if record.cell_type != "code":
+            return False
+        if "sql" not in record.tags or "sql_execute" not in record.tags:
+            return False
+        if "noresult" in record.tags or "plsql" in record.tags or "except" in record.tags:
+            return False
+        statements = split_statements(record.cell["source"])
+        return len(statements) == 1 and READ_ONLY_QUERY.match(statements[0]) is not None
+
+    def index_concurrent_runs(self, compiled: CompiledNotebook) -> dict:
+        """Split the cells into runs of read-only queries separated by state-changing cells.
+
+        Returns a mapping from the index of the first cell of each run to the indexes
+        of all the cells in the run. Markdown and raw cells do not end a run.
+        """
+        runs = {}
+        run = []
+        for record in compiled:
+            if self.is_read_only(record):
+                run.append(record.index)
+            elif record.cell_type == "code":
+                if len(run) > 1:
+                    runs[run[0]] = run
+                run = []
+        if len(run) > 1:
+            runs[run[0]] = run
+        return runs
+
+    def index_result_keys(self, compiled: CompiledNotebook) -> dict:
+        """Key the read-only queries by their normalized text, parameters and database state.
+
+        The database state is a hash of the code cells run before, other than read-only
+        queries, so that queries with the same key are bound to have the same result.
+        """
+        keys = {}
+        state = ""
+        for record in compiled:
+            if self.is_read_only(record):
+                query, limit, dateformat = self.query_params(record)
+                keys[record.index] = hashlib.sha256(
+                    json.dumps([state, normalize(query), limit, dateformat]).encode()
+                ).hexdigest()
+            elif record.cell_type == "code":
+                state = hashlib.sha256(
+                    json.dumps([state, sorted(record.tags), normalize(record.cell["source"])]).encode()
+                ).hexdigest()
+        return keys
+
+    def fetch_concurrently(self, indexes):
+        """Run the queries of a run over a connection pool and store their html results."""
+        if self.engine is None:
+            self.engine = create_engine(self.cnx_uri, pool_size=self.jobs, max_overflow=0)
+
+        def fetch(index):
+            query, limit, dateformat = self.query_params(self.compiled[index])
+            with self.engine.connect() as conn:
+                set_session(conn, dateformat)
+                clock = FetchClock() if self.profile else None
+                if self.stream:
+                    html, rows = stream_query_html(
+                        conn,
+                        query,
+                        self.date_fmt[dateformat],
+                        chunksize=self.chunksize,
+                        limit=limit,
+                        max_rows=self.max_rows,
+                        max_bytes=self.max_bytes,
+                        clock=clock,
+                    )
+                else:
+                    html, rows = query_html(
+                        conn, query, self.date_fmt[dateformat], limit, clock
+                    )
+                stats = query_stats(conn, query, clock.seconds, rows) if self.profile else None
+            return html, stats
+
+        # Only the first of the queries sharing a result key is run
+        pending = {}
+        for index in indexes:
+            key = self.result_keys.get(index, index)
+            if key not in self.results:
+                pending.setdefault(key, index)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {index: executor.submit(fetch, index) for index in pending.values()}
+        for index, future in futures.items():
+            # Failed queries are left to the kernel so that errors are reported as usual
+            if future.exception() is None:
+                self.fetched[index] = future.result()
+
+    def profiler(self, query: str, rows: str) -> dict:
+        """Template parameters timing the fetch of a query and displaying its stats."""
+        if not self.profile:
+            return {"timer": "", "profiler": "", "read_sql": "pd.read_sql", "clock": ""}
+        return {
+            "timer": "    clock = FetchClock()\n",
+            "profiler": f'    display({{STATS_MIME: query_stats(conn, """{query}""", clock.seconds, {rows})}}, raw=True)\n',
+            "read_sql": "clock.read_sql",
+            "clock": ", clock=clock",
+        }
+
+    def collect_stats(self, cell):
+        """Move the stats displayed by a profiled query from its outputs to its metadata."""
+        outputs = []
+        for output in cell.get("outputs", []):
+            if output["output_type"] == "display_data" and STATS_MIME in output["data"]:
+                cell["metadata"]["sql_stats"] = output["data"][STATS_MIME]
+            else:
+                outputs.append(output)
+        cell["outputs"] = outputs
 
     def preprocess_cell(self, cell, resources, index):
-        if (
-            "tags" in cell["metadata"]
-            and "sql" in cell["metadata"]["tags"]
-            and "sql_execute" in cell["metadata"]["tags"]
-        ):
-            limit = fnmatch.filter(cell["metadata"]["tags"], "limit:*")
-            if len(limit) > 0:
-                limiter = f"df.head({int(limit[0].split(':')[1])}).to_html()"
+        record = self.compiled[index]
+        if record.is_sql and "sql_execute" in record.tags:
+            if index in self.concurrent_runs:
+                self.fetch_concurrently(self.concurrent_runs[index])
+            query, limit, dateformat = self.query_params(record)
+            if limit is not None:
+                limiter = f"df.head({limit}).to_html()"
             else:
                 limiter = "df.to_html()"
-            dateformat = fnmatch.filter(cell["metadata"]["tags"], "dateformat:*")
-            if len(dateformat) > 0:
-                dateformat = ":".join(dateformat[0].split(":")[1:])
-            else:
-                dateformat = "YYYY-MM-DD"
-            query = cell["source"]
-            if not ("tags" in cell["metadata"] and "sql" in cell["metadata"]["tags"] and "plsql" in cell["metadata"]["tags"]):
-                query = query.rstrip().rstrip(";")
-            else:
-                query = query.rstrip().rstrip("/").rstrip()
-            if "noresult" in cell["metadata"]["tags"]:
+            if "noresult" in record.tags:
                 cell["source"] = (
                     self.import_str
                     + "\n"
@@ -131,7 +340,7 @@ class SQLExecuteProcessor(ExecutePreprocessor):
                         source=query, dateformat=dateformat
                     )
                 )
-            elif "except" in cell["metadata"]["tags"]:
+            elif "except" in record.tags:
                 cell["source"] = (
                     self.import_str
                     + "\n"
@@ -141,6 +350,23 @@ class SQLExecuteProcessor(ExecutePreprocessor):
                         source=query, limiter=limiter, dateformat=dateformat, dateformat_str=self.date_fmt[dateformat]
                     )
                 )
+            elif self.stream:
+                cell["source"] = (
+                    self.import_str
+                    + "\n"
+                    + self.db_cnx
+                    + "\n"
+                    + self.db_query_stream.format(
+                        source=query,
+                        **self.profiler(query, "rows"),
+                        dateformat=dateformat,
+                        dateformat_str=self.date_fmt[dateformat],
+                        chunksize=self.chunksize,
+                        limit=limit,
+                        max_rows=self.max_rows,
+                        max_bytes=self.max_bytes,
+                    )
+                )
             else:
                 cell["source"] = (
                     self.import_str
@@ -148,14 +374,60 @@ class SQLExecuteProcessor(ExecutePreprocessor):
                     + self.db_cnx
                     + "\n"
                     + self.db_query.format(
-                        source=query, limiter=limiter, dateformat=dateformat, dateformat_str=self.date_fmt[dateformat]
+                        source=query,
+                        limiter=limiter,
+                        dateformat=dateformat,
+                        dateformat_str=self.date_fmt[dateformat],
+                        **self.profiler(query, "len(df)"),
                     )
                 )
             cell["metadata"]["tags"].remove("sql_execute")
             cell["metadata"]["tags"].append("sql_executed")
+            key = self.result_keys.get(index)
+            if key is not None:
+                cell["metadata"]["sql_result_key"] = key
+                if key in self.results:
+                    outputs, stats = self.results[key]
+                    cell["outputs"] = copy.deepcopy(outputs)
+                    if stats is not None:
+                        cell["metadata"]["sql_stats"] = copy.deepcopy(stats)
+                    cell["execution_count"] = None
+                    self.deduplicated += 1
+                    return cell, self.resources
+            if index in self.fetched:
+                html, stats = self.fetched.pop(index)
+                cell["outputs"] = [
+                    new_output(
+                        "execute_result",
+                        data={"text/plain": repr(html)},
+                        execution_count=None,
+                    )
+                ]
+                cell["execution_count"] = None
+                if stats is not None:
+                    cell["metadata"]["sql_stats"] = stats
+            else:
+                cell, resources = super().preprocess_cell(cell, resources, index)
+                if self.profile:
+                    self.collect_stats(cell)
+            if key is not None:
+                self.results[key] = (cell["outputs"], cell["metadata"].get("sql_stats"))
+            return cell, self.resources
         return super().preprocess_cell(cell, resources, index)
 
 
+def cost_cell(stats: dict) -> dict:
+    """Teacher-only cell showing the fetch time, row count and plan of a query."""
+    source = f"Fetch time: {stats['seconds'] * 1000:.1f} ms, rows: {stats['rows']}\n"
+    if stats["plan"]:
+        source += "\n".join(stats["plan"]) + "\n"
+    return {
+        "cell_type": "markdown",
+        "metadata": {"tags": ["sql_source", "sql_cost", "correction"]},
+        "source": "```console\n" + source + "```",
+    }
+
+
 class CleanupProcessor(ExecutePreprocessor):
     def __init__(self, **kw):
         super().__init__(**kw)
@@ -163,15 +435,12 @@ class CleanupProcessor(ExecutePreprocessor):
     def preprocess(
         self, nb: NotebookNode, resources: Any = None, km: KernelManager | None = None
     ) -> Tuple[NotebookNode, dict]:
-        cells = nb["cells"][:]
+        compiled = compile_notebook(nb)
         nb["cells"] = []
-        for c in cells:
-            if (
-                "tags" in c["metadata"]
-                and "outputs" in c
-                and "sql_executed" in c["metadata"]["tags"]
-            ):
-                if len(c["outputs"]) > 0 and "noresult" not in c["metadata"]["tags"] and "except" not in c["metadata"]["tags"]:
+        for record in compiled:
+            c = record.cell
+            if "outputs" in c and "sql_executed" in record.tags:
+                if len(c["outputs"]) > 0 and "noresult" not in record.tags and "except" not in record.tags:
                     c["metadata"]["tags"].remove("sql_executed")
                     c["metadata"]["tags"].append("sql_result")
                     output = c["outputs"][0]["data"]["text/plain"]
@@ -182,8 +451,15 @@ class CleanupProcessor(ExecutePreprocessor):
                         "metadata": {"tags": c["metadata"]["tags"]},
                         "source": output2[1:-1],
                     }
+                    stats = c["metadata"].get("sql_stats")
+                    if stats is not None:
+                        pre["metadata"]["sql_stats"] = stats
+                    if "sql_result_key" in c["metadata"]:
+                        pre["metadata"]["sql_result_key"] = c["metadata"]["sql_result_key"]
                     nb["cells"].append(nb_from_dict(pre))
-                elif len(c["outputs"]) > 0 and "noresult" not in c["metadata"]["tags"] and "except" in c["metadata"]["tags"]:
+                    if stats is not None and "cost" in record.tags:
+                        nb["cells"].append(nb_from_dict(cost_cell(stats)))
+                elif len(c["outputs"]) > 0 and "noresult" not in record.tags and "except" in record.tags:
                     c["metadata"]["tags"].remove("sql_executed")
                     output = c["outputs"][0]["text"]
                     pre = {
@@ -192,7 +468,7 @@ class CleanupProcessor(ExecutePreprocessor):
                         "source": "```console\n" + output + "```",
                     }
                     pre["metadata"]["tags"].append("sql_source")
-                    if "oracle" in c["metadata"]["tags"]:
+                    if "oracle" in record.tags:
                         pre["metadata"]["tags"].remove("oracle")
                     nb["cells"].append(nb_from_dict(pre))
             else:
@@ -207,11 +483,8 @@ class StudentPreprocessor(ExecutePreprocessor):
     def preprocess(
         self, nb: NotebookNode, resources: Any = None, km: KernelManager | None = None
     ) -> Tuple[NotebookNode, dict]:
-        cells = nb["cells"][:]
-        nb["cells"] = []
-        for c in cells:
-            if not ("tags" in c["metadata"] and "correction" in c["metadata"]["tags"]):
-                nb["cells"].append(c)
+        compiled = compile_notebook(nb)
+        nb["cells"] = [r.cell for r in compiled if "correction" not in r.tags]
         return super().preprocess(nb, resources, km)
 
 
@@ -235,7 +508,7 @@ class TranscludePreprocessor(Preprocessor):
                     if not target.endswith(".ipynb"):
                         target += ".ipynb"
                     transcluded_path = path.joinpath(target).resolve()
-                    transcluded_nb = nbformat.read(transcluded_path, as_version=4)
+                    transcluded_nb = read_notebook(transcluded_path)
                     nb["cells"].extend(transcluded_nb["cells"])
                 else:
                     nb["cells"].append(c)
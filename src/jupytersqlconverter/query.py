@@ -0,0 +1,182 @@
+from typing import Iterator, List, Optional, Tuple
+
+import re
+import time
+import pandas as pd
+from sqlalchemy import text
+
+
+STATS_MIME = "application/vnd.jupytersqlconverter.stats+json"
+TBODY_OPEN = "<tbody>\n"
+TBODY_CLOSE = "  </tbody>\n</table>"
+ROW_START = re.compile(r"(?=    <tr>\n)")
+
+
+def format_frame(df: pd.DataFrame, dateformat_str: str, start: int = 1) -> pd.DataFrame:
+    """Apply the same formatting as the executed notebook cells to a frame."""
+    for x in df.select_dtypes(include=["datetime64"]).columns.tolist():
+        df[x] = df[x].dt.strftime(dateformat_str)
+    for x in df.select_dtypes(include=["float64"]).columns.tolist():
+        df[x] = df[x].apply(lambda v: "{:.9g}".format(v))
+    df.fillna("(null)", inplace=True)
+    df = df.replace("nan", "(null)")
+    df.index = pd.RangeIndex(start, start + len(df))
+    return df
+
+
+class FetchClock:
+    """Time spent running a query and fetching its rows, leaving out their formatting
+    and rendering, so that it can be compared whichever way the rows are rendered."""
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def read_sql(self, **kw):
+        started = time.perf_counter()
+        result = pd.read_sql(**kw)
+        self.seconds += time.perf_counter() - started
+        if kw.get("chunksize") is None:
+            return result
+        return self.chunks(result)
+
+    def chunks(self, chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        while True:
+            started = time.perf_counter()
+            chunk = next(chunks, None)
+            self.seconds += time.perf_counter() - started
+            if chunk is None:
+                return
+            yield chunk
+
+
+def set_session(conn, dateformat: str):
+    if conn.dialect.name != "oracle":
+        return
+    conn.execute(text("ALTER SESSION SET NLS_TERRITORY = FRANCE"))
+    conn.execute(text("ALTER SESSION SET NLS_LANGUAGE = FRENCH"))
+    conn.execute(text(f"ALTER SESSION SET NLS_DATE_FORMAT = '{dateformat}'"))
+
+
+def query_html(
+    conn,
+    query: str,
+    dateformat_str: str,
+    limit: Optional[int] = None,
+    clock: Optional[FetchClock] = None,
+) -> Tuple[str, int]:
+    """Run a query and render it as an html table, like the executed notebook cells do.
+
+    Returns the html table and the number of rows returned by the query.
+    """
+    read_sql = pd.read_sql if clock is None else clock.read_sql
+    df = format_frame(read_sql(sql=query, con=conn), dateformat_str)
+    rows = len(df)
+    if limit is not None:
+        df = df.head(limit)
+    return df.to_html(), rows
+
+
+def explain_plan(conn, query: str) -> Optional[List[str]]:
+    """Execution plan of a query as text lines, None if the dialect is not supported."""
+    dialect = conn.dialect.name
+    if dialect == "oracle":
+        conn.exec_driver_sql("EXPLAIN PLAN FOR " + query)
+        result = conn.exec_driver_sql("SELECT plan_table_output FROM TABLE(DBMS_XPLAN.DISPLAY())")
+        return [row[0] for row in result]
+    if dialect == "sqlite":
+        depth = {0: -1}
+        lines = []
+        for id_, parent, _, detail in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + query):
+            depth[id_] = depth.get(parent, -1) + 1
+            lines.append("  " * depth[id_] + detail)
+        return lines
+    if dialect == "postgresql":
+        return [row[0] for row in conn.exec_driver_sql("EXPLAIN " + query)]
+    if dialect in ("mysql", "mariadb"):
+        # One row per table access, rendered with the column names as a header
+        result = conn.exec_driver_sql("EXPLAIN " + query)
+        lines = [" | ".join(result.keys())]
+        for row in result:
+            lines.append(" | ".join("" if v is None else str(v) for v in row))
+        return lines
+    return None
+
+
+def query_stats(conn, query: str, seconds: float, rows: int) -> dict:
+    """Fetch time, row count and plan of a query that just ran."""
+    try:
+        plan = explain_plan(conn, query)
+    except Exception as e:
+        plan = [f"Could not explain the query: {e}"]
+    return {"query": query, "seconds": seconds, "rows": rows, "plan": plan}
+
+
+def _split_table(table_html: str) -> Tuple[str, str]:
+    head, body = table_html.split(TBODY_OPEN, 1)
+    body = body.rsplit(TBODY_CLOSE, 1)[0]
+    return head + TBODY_OPEN, body
+
+
+def stream_query_html(
+    conn,
+    query: str,
+    dateformat_str: str,
+    chunksize: int = 1000,
+    limit: Optional[int] = None,
+    max_rows: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    clock: Optional[FetchClock] = None,
+) -> Tuple[str, int]:
+    """Run a query over a server-side cursor and render it as an html table chunk by chunk.
+
+    Only the current chunk and the rendered html are kept in memory. Rows past
+    ``limit`` are silently dropped, like the ``limit:`` tag does, while rows past
+    ``max_rows`` or ``max_bytes`` are replaced with a truncation marker holding the
+    true row count.
+
+    Returns the html table and the number of rows returned by the query.
+    """
+    conn = conn.execution_options(stream_results=True)
+    capped = max_rows is not None and (limit is None or max_rows < limit)
+    wanted = max_rows if capped else limit
+    head = None
+    pieces = []
+    size = 0
+    shown = 0
+    total = 0
+    columns = 0
+    full = False
+    overflow = False
+    read_sql = pd.read_sql if clock is None else clock.read_sql
+    for chunk in read_sql(sql=query, con=conn, chunksize=chunksize):
+        total += len(chunk)
+        if full:
+            # Keep reading only to get the true row count
+            continue
+        if wanted is not None:
+            chunk = chunk.head(wanted - shown)
+        chunk = format_frame(chunk, dateformat_str, start=shown + 1)
+        columns = len(chunk.columns)
+        chunk_head, body = _split_table(chunk.to_html())
+        if head is None:
+            head = chunk_head
+            size = len(head.encode()) + len(TBODY_CLOSE.encode())
+        for row in ROW_START.split(body):
+            if not row:
+                continue
+            row_size = len(row.encode())
+            if max_bytes is not None and size + row_size > max_bytes:
+                overflow = True
+                break
+            pieces.append(row)
+            size += row_size
+            shown += 1
+        full = overflow or (wanted is not None and shown >= wanted)
+    if overflow or (capped and total > shown):
+        pieces.append(
+            "    <tr>\n"
+            "      <th>…</th>\n"
+            f'      <td colspan="{columns}">{shown} / {total} rows</td>\n'
+            "    </tr>\n"
+        )
+    return (head or "") + "".join(pieces) + TBODY_CLOSE, total
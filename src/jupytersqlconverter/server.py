@@ -0,0 +1,413 @@
+import hashlib
+import ipaddress
+import json
+import math
+import os
+import queue
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import parse_qs, urlparse
+
+from nbformat import NotebookNode
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+
+from .kernels import KernelPool
+from .nbio import notebook_from_dict, notebook_to_dict
+from .pipeline import (
+    ConvertMode,
+    convert_notebook,
+    evaluate_notebook,
+    evaluation_pool,
+    extract_notebook_images,
+    student_notebook,
+)
+
+
+MAX_WAIT = 300
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    __slots__ = (
+        "id",
+        "kind",
+        "key",
+        "payload",
+        "status",
+        "result",
+        "error",
+        "submitted",
+        "started",
+        "finished",
+        "size",
+        "done",
+    )
+
+    def __init__(self, kind: str, key: str, payload: dict):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.payload = payload
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.size = 0
+        self.done = threading.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class ConversionService:
+    """Bounded job queue served by a pool of warm worker threads.
+
+    Jobs with identical payloads are deduplicated while they are queued, running or
+    kept in the finished jobs history. The payload of a job is dropped once it has
+    run, and finished jobs are forgotten past history jobs, past ttl seconds, or
+    while their results take more than max_result_bytes.
+
+    Engines are kept open between jobs, one per connection string, and used by the
+    eval jobs running queries concurrently (the jobs option). Cells executed in a
+    kernel connect with an engine of their own, created once per kernel when kernels
+    is set, as pools of pre-warmed kernels are then kept per connection string.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        queue_size: int = 16,
+        history: int = 256,
+        ttl: float = 600,
+        max_result_bytes: int = 256 * 2**20,
+        kernels: int = 0,
+        max_reuse: int = 20,
+    ):
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.keys: Dict[str, str] = {}
+        self.queue: "queue.Queue[Job]" = queue.Queue(maxsize=queue_size)
+        self.history = history
+        self.ttl = ttl
+        self.max_result_bytes = max_result_bytes
+        self.lock = threading.Lock()
+        self.engines: Dict[str, Engine] = {}
+        self.kernels = kernels
+        self.max_reuse = max_reuse
+        self.pools: Dict[str, KernelPool] = {}
+        self.metrics = {
+            "submitted": 0,
+            "deduplicated": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0,
+            "running": 0,
+            "seconds": {},
+        }
+        self.handlers: Dict[str, Callable[[dict], Any]] = {
+            "eval": self.run_eval,
+            "student": self.run_student,
+            "convert": self.run_convert,
+            "extract": self.run_extract,
+        }
+        self.workers = [
+            threading.Thread(target=self.work, name=f"worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for w in self.workers:
+            w.start()
+
+    def submit(self, kind: str, payload: dict) -> Job:
+        if kind not in self.handlers:
+            raise KeyError(kind)
+        key = hashlib.sha256(
+            json.dumps([kind, payload], sort_keys=True).encode()
+        ).hexdigest()
+        with self.lock:
+            job_id = self.keys.get(key)
+            if job_id is not None and self.jobs[job_id].status != "failed":
+                self.metrics["deduplicated"] += 1
+                return self.jobs[job_id]
+            job = Job(kind, key, payload)
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                self.metrics["rejected"] += 1
+                raise QueueFull()
+            self.jobs[job.id] = job
+            self.keys[key] = job.id
+            self.metrics["submitted"] += 1
+            self.forget()
+        return job
+
+    def forget(self):
+        """Drop the finished jobs past the history size or age, oldest first, and the
+        oldest ones while the results kept are too large."""
+        now = time.time()
+        finished = [j for j in self.jobs.values() if j.finished is not None]
+        excess = len(finished) - self.history
+        size = sum(j.size for j in finished)
+        for job in finished:
+            if excess > 0 or size > self.max_result_bytes or now - job.finished > self.ttl:
+                excess -= 1
+                size -= job.size
+                del self.jobs[job.id]
+                if self.keys.get(job.key) == job.id:
+                    del self.keys[job.key]
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                job.status = "running"
+                job.started = time.time()
+                self.metrics["running"] += 1
+            try:
+                result = self.handlers[job.kind](job.payload)
+                status = "done"
+            except Exception as e:
+                result = None
+                status = "failed"
+                job.error = "".join(traceback.format_exception_only(type(e), e)).strip()
+            size = len(json.dumps(result)) if result is not None else 0
+            with self.lock:
+                job.payload = None
+                job.result = result
+                job.size = size
+                job.status = status
+                job.finished = time.time()
+                self.metrics["running"] -= 1
+                self.metrics["completed" if status == "done" else "failed"] += 1
+                seconds = self.metrics["seconds"]
+                seconds[job.kind] = seconds.get(job.kind, 0) + job.finished - job.started
+                self.forget()
+            job.done.set()
+            self.queue.task_done()
+
+    def engine(self, db: str) -> Engine:
+        with self.lock:
+            if db not in self.engines:
+                self.engines[db] = create_engine(db)
+            return self.engines[db]
+
+    def pool(self, db: str) -> Optional[KernelPool]:
+        if not self.kernels:
+            return None
+        with self.lock:
+            if db not in self.pools:
+                self.pools[db] = evaluation_pool(db, self.kernels, self.max_reuse)
+            return self.pools[db]
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown()
+        for engine in self.engines.values():
+            engine.dispose()
+
+    @staticmethod
+    def read_notebook(payload: dict) -> NotebookNode:
+        return notebook_from_dict(payload["notebook"], payload.get("validate", True))
+
+    def run_eval(self, payload: dict) -> dict:
+        options = payload.get("options", {})
+        nb = self.read_notebook(payload)
+        path = Path(payload.get("path", "."))
+        evaluate_notebook(
+            nb,
+            payload["db"],
+            path,
+            self.pool(payload["db"]),
+            engine=self.engine(payload["db"]),
+            **options,
+        )
+        return {"notebook": notebook_to_dict(nb)}
+
+    def run_student(self, payload: dict) -> dict:
+        nb = self.read_notebook(payload)
+        student_notebook(nb, Path(payload.get("path", ".")))
+        return {"notebook": notebook_to_dict(nb)}
+
+    def run_convert(self, payload: dict) -> dict:
+        nb = self.read_notebook(payload)
+        template = payload.get("template")
+        output = convert_notebook(
+            nb,
+            payload.get("name", "notebook"),
+            Path(payload.get("output_path", ".")),
+            ConvertMode(payload.get("mode", ConvertMode.markdown.value)),
+            Path(template) if template is not None else None,
+            payload.get("native_tables", False),
+        )
+        return {"output": output}
+
+    def run_extract(self, payload: dict) -> dict:
+        nb = self.read_notebook(payload)
+        images = extract_notebook_images(
+            nb, payload.get("name", "notebook"), Path(payload["output_path"])
+        )
+        return {"images": [str(i) for i in images]}
+
+    def health(self) -> dict:
+        return {
+            "status": "ok" if all(w.is_alive() for w in self.workers) else "degraded",
+            "workers": len(self.workers),
+            "queued": self.queue.qsize(),
+        }
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            metrics = dict(self.metrics, seconds=dict(self.metrics["seconds"]))
+            metrics["results_bytes"] = sum(j.size for j in self.jobs.values())
+        metrics["queued"] = self.queue.qsize()
+        metrics["engines"] = len(self.engines)
+        return metrics
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """Routes:
+
+    - POST /jobs/<eval|student|convert|extract> with a json payload, returns the job
+    - GET /jobs/<id>[?wait=<seconds>], returns the job, waiting for it if asked
+      (up to MAX_WAIT seconds)
+    - GET /health and GET /metrics
+
+    There is no authentication: jobs run notebook code and read and write files
+    on behalf of their clients, so the service only listens on a Unix socket, the
+    intended transport, or on a loopback address.
+    """
+
+    service: ConversionService
+
+    def send_json(self, status: HTTPStatus, body: Any):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts == ["health"]:
+            return self.send_json(HTTPStatus.OK, self.service.health())
+        if parts == ["metrics"]:
+            return self.send_json(HTTPStatus.OK, self.service.get_metrics())
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = self.service.jobs.get(parts[1])
+            if job is None:
+                return self.send_json(HTTPStatus.NOT_FOUND, {"error": "unknown job"})
+            wait = parse_qs(url.query).get("wait")
+            if wait:
+                try:
+                    timeout = float(wait[0])
+                except ValueError:
+                    timeout = math.nan
+                if not 0 <= timeout < math.inf:
+                    return self.send_json(
+                        HTTPStatus.BAD_REQUEST, {"error": "wait must be a number of seconds"}
+                    )
+                job.done.wait(min(timeout, MAX_WAIT))
+            return self.send_json(HTTPStatus.OK, job.to_dict())
+        self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+    def do_POST(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "jobs":
+            return self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            job = self.service.submit(parts[1], payload)
+        except KeyError:
+            return self.send_json(HTTPStatus.NOT_FOUND, {"error": f"unknown job kind {parts[1]}"})
+        except ValueError as e:
+            return self.send_json(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+        except QueueFull:
+            return self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"error": "job queue is full"})
+        self.send_json(HTTPStatus.ACCEPTED, job.to_dict())
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        path = self.server_address
+        try:
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError(f"{path} exists and is not a socket")
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        # Only the user running the service can connect: the socket is created in a
+        # private directory and made private before it is moved in place
+        private = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            self.server_address = os.path.join(private, "socket")
+            socketserver.TCPServer.server_bind(self)
+            os.chmod(self.server_address, 0o600)
+            os.rename(self.server_address, path)
+            self.server_address = path
+        finally:
+            if os.path.exists(self.server_address) and self.server_address != path:
+                os.remove(self.server_address)
+            os.rmdir(private)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def is_loopback(host: str) -> bool:
+    try:
+        addresses = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    return all(
+        ipaddress.ip_address(address[4][0].split("%")[0]).is_loopback for address in addresses
+    )
+
+
+def make_server(
+    service: ConversionService,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    unix_socket: Optional[Path] = None,
+) -> ThreadingHTTPServer:
+    """Serve on a Unix socket if given, otherwise on a TCP port of a loopback address."""
+    if unix_socket is None and not is_loopback(host):
+        raise ValueError(
+            f"Refusing to listen on {host}: the service runs notebook code without"
+            " authentication, use a loopback address or a Unix socket."
+        )
+    handler = type("BoundServiceHandler", (ServiceHandler,), {"service": service})
+    if unix_socket is not None:
+        return UnixHTTPServer(str(unix_socket), handler)
+    return ThreadingHTTPServer((host, port), handler)
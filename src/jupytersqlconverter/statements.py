@@ -0,0 +1,203 @@
+from decimal import Decimal
+from typing import List, Optional, Tuple
+
+import re
+from sqlalchemy import Numeric, bindparam, text
+
+
+TOKENS = re.compile(
+    r"(?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))"
+    r"|(?P<qstring>[nN]?[qQ]'(?:\[.*?\]|\(.*?\)|\{.*?\}|<.*?>|(?P<delim>\S).*?(?P=delim))')"
+    r"|(?P<string>[nN]?'(?:[^']|'')*(?:'|\Z))"
+    r"|(?P<ident>\"[^\"]*(?:\"|\Z)|[^\W\d][\w$#]*)"
+    r"|(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)"
+    r"|(?P<space>\s+)"
+    r"|(?P<other>.)",
+    re.S,
+)
+
+# BEGIN also starts transactions, and CREATE TYPE also creates PostgreSQL types:
+# only the PL/SQL forms open a block
+PLSQL_BLOCK = re.compile(
+    r"(DECLARE\b"
+    r"|BEGIN\b(?!\s*(;|$|(TRANSACTION|TRAN|WORK|DEFERRED|IMMEDIATE|EXCLUSIVE)\b))"
+    r"|CREATE\s+(OR\s+REPLACE\s+)?((NON)?EDITIONABLE\s+)?"
+    r"(FUNCTION|PROCEDURE|PACKAGE|TRIGGER"
+    r"|TYPE\s+(BODY\b|[\w$#.\"]+\s+(FORCE\s+)?(AUTHID\s+\w+\s+)?"
+    r"(UNDER|(AS|IS)\s+(OBJECT|TABLE|VARRAY|VARYING))\b)))",
+    re.I,
+)
+
+TYPED_LITERALS = frozenset(["DATE", "TIMESTAMP", "INTERVAL"])
+
+
+def _alone_on_line(source: str, m: re.Match) -> bool:
+    line_start = source.rfind("\n", 0, m.start()) + 1
+    line_end = source.find("\n", m.end())
+    if line_end < 0:
+        line_end = len(source)
+    return source[line_start:line_end].strip() == "/"
+
+
+def split_statements(source: str) -> List[str]:
+    """Split a SQL script into statements.
+
+    Statements end with a ``;`` outside of string literals, quoted identifiers and
+    comments. PL/SQL blocks (anonymous blocks, functions, procedures, packages,
+    triggers and types) keep their inner ``;`` and end with a line holding only a
+    ``/``, like in SQL*Plus. Segments made only of comments are dropped.
+    """
+    statements = []
+    first = None
+    plsql = False
+    for m in TOKENS.finditer(source):
+        kind = m.lastgroup
+        if kind in ("comment", "space"):
+            continue
+        if kind == "other" and m.group() == "/" and _alone_on_line(source, m):
+            if first is not None:
+                statements.append(source[first : m.start()])
+            first = None
+            continue
+        if first is None:
+            first = m.start()
+            plsql = PLSQL_BLOCK.match(source, m.start()) is not None
+        if not plsql and kind == "other" and m.group() == ";":
+            statements.append(source[first : m.start()])
+            first = None
+    if first is not None:
+        statements.append(source[first:])
+    return [s.strip() for s in statements if s.strip() != ""]
+
+
+def normalize(source: str) -> str:
+    """Canonical text of a SQL script, identical for scripts that only differ by their
+    comments, whitespace or trailing ``;``.
+
+    Case is kept: the headers of the results come from the identifiers as written
+    on some databases, like SQLite and MySQL.
+    """
+    parts = []
+    for m in TOKENS.finditer(source):
+        if m.lastgroup in ("comment", "space"):
+            if parts and parts[-1] != " ":
+                parts.append(" ")
+        else:
+            parts.append(m.group())
+    return "".join(parts).strip().rstrip(";").rstrip()
+
+
+def is_values_insert(statement: str) -> bool:
+    """Tell whether a statement is a single row ``INSERT [INTO] t [(columns)] VALUES (...)``."""
+    tokens = [
+        (m.lastgroup, m.group().upper())
+        for m in TOKENS.finditer(statement)
+        if m.lastgroup not in ("comment", "space")
+    ]
+    values = [v for _, v in tokens]
+    if values[:1] != ["INSERT"]:
+        return False
+    i = 2 if values[1:2] == ["INTO"] else 1
+    if tokens[i : i + 1] == [] or tokens[i][0] != "ident":
+        return False
+    i += 1
+    while values[i : i + 1] == ["."] and tokens[i + 1 : i + 2] and tokens[i + 1][0] == "ident":
+        i += 2
+    if values[i : i + 1] == ["("]:
+        if ")" not in values[i:]:
+            return False
+        close = values.index(")", i)
+        if any(k != "ident" and v != "," for k, v in tokens[i + 1 : close]):
+            return False
+        i = close + 1
+    if values[i : i + 2] != ["VALUES", "("]:
+        return False
+    depth = 0
+    for j in range(i + 1, len(tokens)):
+        kind, value = tokens[j]
+        if kind == "ident" and value == "SELECT":
+            return False
+        if value == "(":
+            depth += 1
+        elif value == ")":
+            depth -= 1
+            if depth == 0:
+                return j == len(tokens) - 1
+    return False
+
+
+def parameterize(statement: str) -> Optional[Tuple[str, dict]]:
+    """Replace the string and numeric literals of a statement with bind parameters.
+
+    Returns the statement template and the parameter values, or None when the
+    statement cannot be safely turned into a template.
+    """
+    parts = []
+    params = {}
+    previous = None
+    for m in TOKENS.finditer(statement):
+        kind = m.lastgroup
+        value = m.group()
+        if kind == "qstring" or (kind == "ident" and ":" in value):
+            return None
+        if kind == "string" and previous in TYPED_LITERALS:
+            # DATE '...' and the like cannot take a bind parameter in place of the string
+            parts.append(value)
+        elif kind == "string" and value[0] == "'" and value.endswith("'") and len(value) > 1:
+            name = f"p{len(params)}"
+            params[name] = value[1:-1].replace("''", "'")
+            parts.append(":" + name)
+        elif kind == "number":
+            name = f"p{len(params)}"
+            if re.fullmatch(r"\d+", value):
+                params[name] = int(value)
+            else:
+                params[name] = Decimal(value)
+            parts.append(":" + name)
+        elif kind == "comment":
+            continue
+        elif kind == "space":
+            parts.append(value)
+            continue
+        else:
+            parts.append(value)
+        previous = value.upper()
+    return "".join(parts), params
+
+
+def execute_script(conn, source: str):
+    """Execute a SQL script in a single transaction.
+
+    Runs of consecutive single row INSERT ... VALUES statements that only differ by
+    their literal values are sent as a single executemany call.
+    """
+    key = None
+    batch = []
+
+    def flush():
+        if batch:
+            template, types = key
+            stmt = text(template).bindparams(
+                *[
+                    bindparam(name, type_=Numeric())
+                    for name, type_ in zip(batch[0], types)
+                    if type_ is Decimal
+                ]
+            )
+            conn.execute(stmt, batch)
+
+    for statement in split_statements(source):
+        parameterized = parameterize(statement) if is_values_insert(statement) else None
+        if parameterized is not None:
+            template, params = parameterized
+            statement_key = (template, tuple(type(v) for v in params.values()))
+            if statement_key != key:
+                flush()
+                key, batch = statement_key, []
+            batch.append(params)
+            continue
+        flush()
+        key, batch = None, []
+        conn.execute(text(statement))
+    flush()
+    conn.commit()
@@ -11,6 +11,7 @@ from pandoc import read as pandoc_read, write as pandoc_write
 import pandoc
 from pandoc.types import Para, RawInline, Format, Code, BulletList, Plain
 from bs4 import BeautifulSoup as bs
+from .ir import CompiledNotebook, compile_notebook
 
 def get_table_image(url, fn: Path, out_dir: Path, name: str, delay=5):
     """Render HTML file in browser and grab a screenshot."""
@@ -67,60 +68,100 @@ def sql_result_to_png(cell: NotebookNode, name: str, out_dir: Path):
     return False
 
 
+LONGTABLE_ROWS = 30
+LATEX_SPECIAL = {
+    "\\": r"\textbackslash{}",
+    "&": r"\&",
+    "%": r"\%",
+    "$": r"\$",
+    "#": r"\#",
+    "_": r"\_",
+    "{": r"\{",
+    "}": r"\}",
+    "~": r"\textasciitilde{}",
+    "^": r"\textasciicircum{}",
+}
+
+
+def latex_escape(text: str) -> str:
+    return "".join(LATEX_SPECIAL.get(ch, ch) for ch in text)
+
+
+def sql_result_to_latex(table_html: str, fit_width: bool = False) -> str:
+    """Render an html result table as a LaTeX tabular styled like the table images.
+
+    Tables longer than LONGTABLE_ROWS rows use a longtable so they can break across
+    pages, unless fit_width is set, in which case the table is scaled down to the
+    line width when needed. Needs the xcolor (with the table option) and longtable
+    packages.
+    """
+    table = bs(table_html, "html.parser").find("table")
+    header = [latex_escape(th.text) for th in table.thead.find_all("th")]
+    rows = []
+    for tr in table.tbody.find_all("tr"):
+        row = []
+        for td in tr.find_all(["th", "td"]):
+            value = latex_escape(td.text)
+            if td.name == "th":
+                value = f"\\textbf{{{value}}}"
+            span = int(td.get("colspan", 1))
+            if span > 1:
+                value = f"\\multicolumn{{{span}}}{{l|}}{{{value}}}"
+            row.append(value)
+        rows.append(" & ".join(row) + r" \\ \hline")
+    spec = "|" + "l|" * len(header)
+    head = (
+        "\\hline\n\\rowcolor[HTML]{79B6EC} "
+        + " & ".join(header)
+        + r" \\ \hline"
+    )
+    if len(rows) > LONGTABLE_ROWS and not fit_width:
+        body = (
+            f"\\begin{{longtable}}{{{spec}}}\n{head}\n\\endhead\n"
+            + "\n".join(rows)
+            + "\n\\end{longtable}"
+        )
+    else:
+        body = f"\\begin{{tabular}}{{{spec}}}\n{head}\n" + "\n".join(rows) + "\n\\end{tabular}"
+        if fit_width:
+            body = (
+                "\\resizebox{\\ifdim\\width>\\linewidth\\linewidth\\else\\width\\fi}{!}{%\n"
+                + body
+                + "}"
+            )
+        body = "\\begin{center}\n" + body + "\n\\end{center}"
+    return "{\\arrayrulecolor[HTML]{DDEEEE}\n" + body + "\n}"
+
+
 def include_notebook(main: NotebookNode, included: NotebookNode) -> NotebookNode:
     # TODO: merge
     pass
 
 
-def index_solution_cells(cells: List[NotebookNode]) -> List[str]:
-    cell_index = [None]
-    for cell in cells:
-        if "tags" in cell["metadata"] and "correction" in cell["metadata"]["tags"]:
-            if cell_index[-1] is None:
-                cell_index.append("solution_start_end")
-            elif cell_index[-1] == "solution_start_end":
-                cell_index[-1] = "solution_start"
-                cell_index.append("solution")
-            elif cell_index[-1] == "solution":
-                cell_index.append("solution")
-            else:
-                raise Exception(f"Unexpected cell type in solution cells : {cell_index}")
-        else:
-            if cell_index[-1] is None:
-                cell_index.append(None)
-            elif cell_index[-1] in ["solution_start_end", "solution_end"]:
-                cell_index.append(None)
-            elif cell_index[-1] == "solution":
-                cell_index[-1] = "solution_end"
-                cell_index.append(None)
-            else:
-                raise Exception(f"Unexpected cell type in non-solution cells : {cell_index}")
-    cell_index.pop(0)
-    return cell_index
-
-
 def preprocess_cells_latex(
-    nb: NotebookNode, output_path: str, image_name: str
+    nb: NotebookNode | CompiledNotebook,
+    output_path: str,
+    image_name: str,
+    native_tables: bool = False,
 ) -> List[NotebookNode]:
     cells = []
     i = 0
-    cell_index = index_solution_cells(nb["cells"])
-    cell_number = 0
-    if cell_index[-1] == "solution":
-        cell_index[-1] = "solution_end"
-    for cell in nb["cells"]:
+    compiled = compile_notebook(nb)
+    for record in compiled:
+        cell = record.cell
         c = cell.copy()
-        if cell_index[cell_number] is not None:
-            c["type"] = cell_index[cell_number]
-        cell_number += 1
+        if record.solution is not None:
+            c["type"] = record.solution
+            if record.index == len(compiled) - 1 and record.solution == "solution":
+                c["type"] = "solution_end"
         if (
-            cell["cell_type"] == "markdown"
-            and "tags" in cell["metadata"]
-            and "sql_source" in cell["metadata"]["tags"]
+            record.cell_type == "markdown"
+            and record.tagged
+            and "sql_source" in record.tags
         ):
             #p = pandoc_read(cell["source"])
             out = cell["source"]
-            if "oracle" in cell["metadata"]["tags"]:
+            if "oracle" in record.tags:
                 out = out.replace(r"```sql", r"\begin{minted}[breaklines, breaksymbol={},bgcolor=shadecolor]{oraclesql}")
             else:
                 out = re.sub(r"```(?P<lang>\w+)", r"\\begin{minted}[breaklines, breaksymbol={},bgcolor=shadecolor]{\g<lang>}", out) #out.replace(r"```sql", r"\begin{minted}[breaklines, breaksymbol={},bgcolor=shadecolor]{sql}")
@@ -129,11 +170,11 @@ def preprocess_cells_latex(
             c["source"] = out
             cells.append(c)
         elif (
-            cell["cell_type"] == "markdown"
-            and "tags" in cell["metadata"]
-            and "sql_result" in cell["metadata"]["tags"]
+            record.cell_type == "markdown"
+            and record.tagged
+            and "sql_result" in record.tags
         ):
-            if "extract" in cell["metadata"]["tags"]:
+            if "extract" in record.tags:
                 import os
                 c["metadata"]["tags"].remove("sql_result")
                 c["metadata"]["tags"].append("sql_source")
@@ -147,6 +188,12 @@ def preprocess_cells_latex(
                     code
                 )
                 cells.append(c)
+            elif native_tables:
+                i += 1
+                c["source"] = sql_result_to_latex(
+                    cell["source"], "fitwidth" in record.tags
+                )
+                cells.append(c)
             else:
                 i += 1
                 c["source"] = (
@@ -154,9 +201,9 @@ def preprocess_cells_latex(
                 )
                 cells.append(c)
         elif (
-            cell["cell_type"] == "markdown"
-            and "tags" in cell["metadata"]
-            and "sql_source" not in cell["metadata"]["tags"]
+            record.cell_type == "markdown"
+            and record.tagged
+            and "sql_source" not in record.tags
         ):
             p = pandoc_read(cell["source"])
             for el in pandoc.iter(p):
@@ -169,30 +216,20 @@ def preprocess_cells_latex(
             out = out.replace(r"\def\labelenumi{\arabic{enumi}.}", "")
             out = out.replace("\\tightlist", "")
             out = out.replace(r"\ ", " ")
-            if (
-                "enum:start" in cell["metadata"]["tags"]
-                or "enum:cont" in cell["metadata"]["tags"]
-            ):
-                out = out.replace("\\end{enumerate}", "")
-            if (
-                "enum:end" in cell["metadata"]["tags"]
-                or "enum:cont" in cell["metadata"]["tags"]
-            ):
-                out = out.replace("\\begin{enumerate}", "")
-            if "enum:end" in cell["metadata"]["tags"] and "\\end{enumerate}" not in out:
-                out = out + "\\end{enumerate}"
-            if (
-                "item:start" in cell["metadata"]["tags"]
-                or "enum:cont" in cell["metadata"]["tags"]
-            ):
-                out = out.replace("\\end{itemize}", "")
-            if (
-                "item:end" in cell["metadata"]["tags"]
-                or "enum:cont" in cell["metadata"]["tags"]
-            ):
-                out = out.replace("\\begin{itemize}", "")
-            if "item:end" in cell["metadata"]["tags"] and "\\end{itemize}" not in out:
-                out = out + "\\end{itemize}"
+            markers = record.markers
+            if markers:
+                if markers & {"enum:start", "enum:cont"}:
+                    out = out.replace("\\end{enumerate}", "")
+                if markers & {"enum:end", "enum:cont"}:
+                    out = out.replace("\\begin{enumerate}", "")
+                if "enum:end" in markers and "\\end{enumerate}" not in out:
+                    out = out + "\\end{enumerate}"
+                if markers & {"item:start", "enum:cont"}:
+                    out = out.replace("\\end{itemize}", "")
+                if markers & {"item:end", "enum:cont"}:
+                    out = out.replace("\\begin{itemize}", "")
+                if "item:end" in markers and "\\end{itemize}" not in out:
+                    out = out + "\\end{itemize}"
             out = "\n".join(x for x in out.splitlines() if "\\setcounter{enumi}" not in x)
             c["source"] = out
             cells.append(c)
@@ -213,27 +250,25 @@ def preprocess_cells_latex(
 
 
 def preprocess_cells_markdown(
-    nb: NotebookNode, output_path: str, image_name: str
+    nb: NotebookNode | CompiledNotebook, output_path: str, image_name: str
 ) -> List[NotebookNode]:
     cells = []
     i = 0
-    cell_index = index_solution_cells(nb["cells"])
-    cell_number = 0
-    for cell in nb["cells"]:
+    for record in compile_notebook(nb):
+        cell = record.cell
         c = cell.copy()
-        if cell_index[cell_number] is not None:
-            c["type"] = cell_index[cell_number]
-        cell_number += 1
+        if record.solution is not None:
+            c["type"] = record.solution
         if (
-            cell["cell_type"] == "markdown"
-            and "tags" in cell["metadata"]
-            and "sql_source" in cell["metadata"]["tags"]
+            record.cell_type == "markdown"
+            and record.tagged
+            and "sql_source" in record.tags
         ):
             cells.append(c)
         elif (
-            cell["cell_type"] == "markdown"
-            and "tags" in cell["metadata"]
-            and "sql_result" in cell["metadata"]["tags"]
+            record.cell_type == "markdown"
+            and record.tagged
+            and "sql_result" in record.tags
         ):
             i += 1
             c["source"] = f"![{image_name}]({output_path}/images/{image_name}_{i}.png)"
@@ -246,25 +281,23 @@ def preprocess_cells_markdown(
     return cells
 
 
-def preprocess_cells_markdown_html(nb: NotebookNode) -> List[NotebookNode]:
+def preprocess_cells_markdown_html(nb: NotebookNode | CompiledNotebook) -> List[NotebookNode]:
     cells = []
-    cell_index = index_solution_cells(nb["cells"])
-    cell_number = 0
-    for cell in nb["cells"]:
+    for record in compile_notebook(nb):
+        cell = record.cell
         c = cell.copy()
-        if cell_index[cell_number] is not None:
-            c["type"] = cell_index[cell_number]
-        cell_number += 1
+        if record.solution is not None:
+            c["type"] = record.solution
         if (
-            cell["cell_type"] == "markdown"
-            and "tags" in cell["metadata"]
-            and "sql_source" in cell["metadata"]["tags"]
+            record.cell_type == "markdown"
+            and record.tagged
+            and "sql_source" in record.tags
         ):
             cells.append(c)
         elif (
-            cell["cell_type"] == "markdown"
-            and "tags" in cell["metadata"]
-            and "sql_result" in cell["metadata"]["tags"]
+            record.cell_type == "markdown"
+            and record.tagged
+            and "sql_result" in record.tags
         ):
             cells.append(c)
         else:
@@ -0,0 +1,42 @@
+import time
+
+import pytest
+from nbformat.v4 import new_code_cell, new_notebook
+
+from jupytersqlconverter.pipeline import evaluate_notebook, evaluation_pool
+
+
+@pytest.fixture
+def db(tmp_path):
+    return f"sqlite:///{tmp_path / 'test.db'}"
+
+
+def notebook(i):
+    return new_notebook(
+        cells=[
+            new_code_cell(
+                f"CREATE TABLE t{i} (a INTEGER);\nINSERT INTO t{i} VALUES ({i});",
+                metadata={"tags": ["sql", "noresult"]},
+            ),
+            new_code_cell(f"SELECT a FROM t{i}", metadata={"tags": ["sql"]}),
+        ]
+    )
+
+
+def test_pool_recycles_kernels(db, tmp_path):
+    pool = evaluation_pool(db, size=1, max_uses=3, cwd=tmp_path)
+    try:
+        kernel = pool.kernels[0]
+        start = time.monotonic()
+        for i in range(4):
+            nb = evaluate_notebook(notebook(i), db, tmp_path, pool=pool)
+            results = [c for c in nb.cells if "sql_result" in c.metadata.get("tags", [])]
+            assert len(results) == 1
+            assert f"<td>{i}</td>" in results[0].source
+        # Each notebook hands the kernel back twice: it was restarted, without
+        # waiting for a timeout
+        assert kernel.uses == 2
+        assert kernel.km.is_alive()
+        assert time.monotonic() - start < pool.timeout
+    finally:
+        pool.shutdown()
@@ -0,0 +1,33 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+from jupytersqlconverter.query import query_html, stream_query_html
+
+
+@pytest.fixture
+def conn():
+    engine = create_engine("sqlite://")
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TABLE t (a INTEGER)"))
+        conn.execute(text("INSERT INTO t VALUES " + ", ".join(f"({i})" for i in range(25))))
+        yield conn
+    engine.dispose()
+
+
+def test_stream_matches_query_html(conn):
+    assert stream_query_html(conn, "SELECT * FROM t", "%Y-%m-%d", chunksize=10) == query_html(
+        conn, "SELECT * FROM t", "%Y-%m-%d"
+    )
+
+
+def test_stream_limit_counts_all_rows(conn):
+    html, rows = stream_query_html(conn, "SELECT * FROM t", "%Y-%m-%d", chunksize=10, limit=5)
+    assert rows == 25
+    assert html.count("<tr>") == 5
+    assert html == query_html(conn, "SELECT * FROM t", "%Y-%m-%d", limit=5)[0]
+
+
+def test_stream_max_rows_marker(conn):
+    html, rows = stream_query_html(conn, "SELECT * FROM t", "%Y-%m-%d", chunksize=10, max_rows=3)
+    assert rows == 25
+    assert "3 / 25 rows" in html
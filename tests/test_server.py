@@ -0,0 +1,157 @@
+import json
+import os
+import stat
+import threading
+import urllib.error
+import urllib.request
+
+import nbformat
+import pytest
+from nbformat.v4 import new_code_cell, new_notebook
+
+from jupytersqlconverter.server import ConversionService, make_server
+
+
+def start(service):
+    server = make_server(service, "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def request(url, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data)) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+@pytest.fixture
+def service():
+    services = []
+
+    def make(**kw):
+        service = ConversionService(**kw)
+        server, url = start(service)
+        services.append((service, server))
+        return service, url
+
+    yield make
+    for service, server in services:
+        server.shutdown()
+        server.server_close()
+        service.shutdown()
+
+
+@pytest.fixture
+def payload(tmp_path):
+    nb = new_notebook(
+        cells=[
+            new_code_cell(
+                "CREATE TABLE emp (id INTEGER, name TEXT);\n"
+                "INSERT INTO emp VALUES (1, 'a');\n"
+                "INSERT INTO emp VALUES (2, 'b');",
+                metadata={"tags": ["sql", "noresult"]},
+            ),
+            new_code_cell("SELECT * FROM emp", metadata={"tags": ["sql"]}),
+        ]
+    )
+    return {
+        "db": f"sqlite:///{tmp_path / 'test.db'}",
+        "notebook": json.loads(nbformat.writes(nb)),
+        "path": str(tmp_path),
+    }
+
+
+def test_eval_job(service, payload):
+    svc, url = service(workers=1)
+    status, job = request(url + "/jobs/eval", payload)
+    assert status == 202
+    status, again = request(url + "/jobs/eval", payload)
+    assert again["id"] == job["id"]
+
+    status, job = request(f"{url}/jobs/{job['id']}?wait=120")
+    assert status == 200
+    assert job["status"] == "done", job["error"]
+    cells = job["result"]["notebook"]["cells"]
+    results = [c for c in cells if "sql_result" in c["metadata"]["tags"]]
+    assert len(results) == 1
+    assert "<td>b</td>" in "".join(results[0]["source"])
+    assert svc.jobs[job["id"]].payload is None
+
+    # Finished jobs are still deduplicated
+    status, again = request(url + "/jobs/eval", payload)
+    assert again["id"] == job["id"]
+
+    status, metrics = request(url + "/metrics")
+    assert metrics["submitted"] == 1
+    assert metrics["deduplicated"] == 2
+    assert metrics["completed"] == 1
+    assert metrics["results_bytes"] > 0
+    status, health = request(url + "/health")
+    assert health == {"status": "ok", "workers": 1, "queued": 0}
+
+
+def test_queue_full(service, payload):
+    svc, url = service(workers=0, queue_size=1)
+    status, _ = request(url + "/jobs/eval", payload)
+    assert status == 202
+    status, body = request(url + "/jobs/eval", dict(payload, db="sqlite://"))
+    assert status == 503
+    status, metrics = request(url + "/metrics")
+    assert metrics["rejected"] == 1
+    assert metrics["queued"] == 1
+
+
+def test_bad_requests(service, payload):
+    svc, url = service(workers=0)
+    assert request(url + "/jobs/unknown", payload)[0] == 404
+    assert request(url + "/jobs/nope")[0] == 404
+    _, job = request(url + "/jobs/eval", payload)
+    assert request(f"{url}/jobs/{job['id']}?wait=abc")[0] == 400
+    assert request(f"{url}/jobs/{job['id']}?wait=-1")[0] == 400
+
+
+def test_history_is_bounded():
+    svc = ConversionService(workers=1, history=2, max_result_bytes=100)
+    try:
+        svc.handlers["echo"] = lambda payload: payload
+        for i in range(3):
+            svc.submit("echo", {"i": i}).done.wait(10)
+        assert [j.result for j in svc.jobs.values()] == [{"i": 1}, {"i": 2}]
+
+        big = svc.submit("echo", {"data": "x" * 200})
+        big.done.wait(10)
+        assert big.id not in svc.jobs
+        assert svc.submit("echo", {"data": "x" * 200}).id != big.id
+
+        svc.ttl = 0
+        svc.submit("echo", {"i": 3}).done.wait(10)
+        assert len(svc.jobs) == 0
+    finally:
+        svc.shutdown()
+
+
+def test_refuses_non_loopback_hosts():
+    svc = ConversionService(workers=0)
+    with pytest.raises(ValueError):
+        make_server(svc, "0.0.0.0", 0)
+
+
+def test_unix_socket(tmp_path):
+    svc = ConversionService(workers=0)
+    try:
+        path = tmp_path / "service.sock"
+        notebook = tmp_path / "notebook.ipynb"
+        for _ in range(2):
+            server = make_server(svc, unix_socket=path)
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+            server.server_close()
+        assert os.listdir(tmp_path) == ["service.sock"]
+
+        notebook.write_text("{}")
+        with pytest.raises(FileExistsError):
+            make_server(svc, unix_socket=notebook)
+    finally:
+        svc.shutdown()
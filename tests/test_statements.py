@@ -0,0 +1,189 @@
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import create_engine, event, text
+
+from jupytersqlconverter.statements import (
+    execute_script,
+    is_values_insert,
+    normalize,
+    parameterize,
+    split_statements,
+)
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    yield engine
+    engine.dispose()
+
+
+def test_split_ignores_semicolons_in_literals_and_comments():
+    source = """SELECT 'a;b' FROM dual;
+-- a comment; still a comment
+SELECT q'[c;d]' FROM dual; /* e;f */ SELECT "g;h" FROM dual"""
+    assert split_statements(source) == [
+        "SELECT 'a;b' FROM dual",
+        "SELECT q'[c;d]' FROM dual",
+        'SELECT "g;h" FROM dual',
+    ]
+
+
+def test_split_keeps_escaped_quotes():
+    assert split_statements("SELECT 'it''s; fine' FROM dual; SELECT 1 FROM dual") == [
+        "SELECT 'it''s; fine' FROM dual",
+        "SELECT 1 FROM dual",
+    ]
+
+
+def test_split_plsql_blocks_end_with_slash():
+    source = """CREATE OR REPLACE PROCEDURE p IS
+BEGIN
+  UPDATE t SET a = 1;
+  COMMIT;
+END;
+/
+BEGIN
+  p;
+END;
+/
+SELECT 1 FROM dual;"""
+    statements = split_statements(source)
+    assert len(statements) == 3
+    assert statements[0].startswith("CREATE OR REPLACE PROCEDURE p")
+    assert statements[0].endswith("END;")
+    assert statements[1] == "BEGIN\n  p;\nEND;"
+    assert statements[2] == "SELECT 1 FROM dual"
+
+
+@pytest.mark.parametrize("begin", ["BEGIN", "BEGIN TRANSACTION", "begin work", "BEGIN DEFERRED TRANSACTION"])
+def test_split_transaction_begin_is_not_a_block(begin):
+    assert split_statements(f"{begin};\nINSERT INTO t VALUES (1);\nCOMMIT;") == [
+        begin,
+        "INSERT INTO t VALUES (1)",
+        "COMMIT",
+    ]
+
+
+def test_split_create_type():
+    source = """CREATE TYPE mood AS ENUM ('sad', 'happy');
+CREATE OR REPLACE TYPE point AS OBJECT (x NUMBER, y NUMBER);
+/
+CREATE TYPE BODY point AS
+  MEMBER FUNCTION norm RETURN NUMBER IS BEGIN RETURN 0; END;
+END;
+/
+CREATE TYPE points IS TABLE OF point;
+/
+SELECT 1 FROM dual;"""
+    statements = split_statements(source)
+    assert statements[0] == "CREATE TYPE mood AS ENUM ('sad', 'happy')"
+    assert statements[1] == "CREATE OR REPLACE TYPE point AS OBJECT (x NUMBER, y NUMBER);"
+    assert statements[2].startswith("CREATE TYPE BODY point") and statements[2].endswith("END;")
+    assert statements[3] == "CREATE TYPE points IS TABLE OF point;"
+    assert statements[4] == "SELECT 1 FROM dual"
+
+
+def test_split_drops_comment_only_segments():
+    assert split_statements("-- nothing\n;\n/* here */") == []
+
+
+def test_normalize():
+    assert normalize("SELECT a,\n  b -- columns\nFROM t ;") == "SELECT a, b FROM t"
+    assert normalize("SELECT name AS Nom FROM t") != normalize("select NAME as NOM from t")
+
+
+def test_parameterize_literals():
+    template, params = parameterize("INSERT INTO t VALUES (1, 2.5, 'it''s', -- c\n 'x')")
+    assert template == "INSERT INTO t VALUES (:p0, :p1, :p2, \n :p3)"
+    assert params == {"p0": 1, "p1": Decimal("2.5"), "p2": "it's", "p3": "x"}
+
+
+@pytest.mark.parametrize(
+    "literal",
+    ["DATE '2020-01-01'", "TIMESTAMP '2020-01-01 10:00:00'", "INTERVAL '3' DAY", "date '2020-01-01'"],
+)
+def test_parameterize_keeps_typed_literals(literal):
+    template, params = parameterize(f"INSERT INTO t VALUES (1, {literal})")
+    assert template == f"INSERT INTO t VALUES (:p0, {literal})"
+    assert params == {"p0": 1}
+
+
+@pytest.mark.parametrize(
+    "statement, expected",
+    [
+        ("INSERT INTO t VALUES (1, 'a')", True),
+        ("insert into s.t (a, b) values (1, (2))", True),
+        ("INSERT t VALUES (1)", True),
+        ("INSERT INTO t SELECT a, count(*) FROM s GROUP BY a ORDER BY 1", False),
+        ("INSERT INTO t VALUES (1), (2)", False),
+        ("INSERT INTO t VALUES ((SELECT max(a) FROM s))", False),
+        ("INSERT ALL INTO t VALUES (1) SELECT * FROM dual", False),
+        ("INSERT INTO t VALUES (1", False),
+    ],
+)
+def test_is_values_insert(statement, expected):
+    assert is_values_insert(statement) is expected
+
+
+def test_parameterize_refuses_q_quotes():
+    assert parameterize("INSERT INTO t VALUES (q'[x]')") is None
+
+
+def test_execute_script_batches_inserts(engine):
+    calls = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def record(conn, cursor, statement, parameters, context, executemany):
+        calls.append((statement, executemany))
+
+    source = """CREATE TABLE t (a NUMERIC, b TEXT);
+INSERT INTO t VALUES (1, 'a');
+INSERT INTO t VALUES (2, 'b');
+INSERT INTO t VALUES (2.5, 'c');
+INSERT INTO t VALUES (3.25, 'd');
+INSERT INTO t VALUES (4, 'e');
+UPDATE t SET b = 'f;g' WHERE a = 4;"""
+    with engine.connect() as conn:
+        execute_script(conn, source)
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT a, b FROM t ORDER BY a")).all()
+
+    assert rows == [(1, "a"), (2, "b"), (2.5, "c"), (3.25, "d"), (4, "f;g")]
+    # int rows, Decimal rows and the last int row are three separate batches
+    inserts = [executemany for statement, executemany in calls if statement.startswith("INSERT")]
+    assert inserts == [True, True, False]
+
+
+def test_execute_script_runs_other_inserts_as_is(engine):
+    source = """CREATE TABLE s (a INTEGER);
+CREATE TABLE t (a INTEGER, n INTEGER);
+INSERT INTO s VALUES (2);
+INSERT INTO s VALUES (1);
+INSERT INTO s VALUES (2);
+INSERT INTO t SELECT a, count(*) FROM s GROUP BY 1 ORDER BY 1;"""
+    with engine.connect() as conn:
+        execute_script(conn, source)
+        assert conn.execute(text("SELECT a, n FROM t ORDER BY a")).all() == [(1, 1), (2, 2)]
+
+
+def test_execute_script_with_transaction_statements(engine):
+    with engine.connect() as conn:
+        execute_script(
+            conn,
+            "CREATE TABLE t (a INTEGER);\nBEGIN TRANSACTION;\n"
+            "INSERT INTO t VALUES (1);\nINSERT INTO t VALUES (2);\nCOMMIT;",
+        )
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM t")).scalar() == 2
+
+
+def test_execute_script_rolls_back_on_error(engine):
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TABLE t (a INTEGER)"))
+        conn.commit()
+        with pytest.raises(Exception):
+            execute_script(conn, "INSERT INTO t VALUES (1); INSERT INTO nope VALUES (2);")
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM t")).scalar() == 0